@@ -1,210 +1,242 @@
+import time
+
+# 启动计时从导入本模块开始；设置环境变量 PHOTOASSISTANT_STARTUP_TIMING=1 或使用 --startup-timing 参数时
+# 在窗口显示后输出各阶段的耗时
+STARTUP_TIME = time.perf_counter()
+startup_marks = []
 
 import os
-import datetime
-import shutil
-import hashlib
 import logging
-import subprocess
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import configparser
-from pathlib import Path
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QLineEdit, \
     QFileDialog, QProgressBar, QComboBox, QTextEdit, QMessageBox, QCheckBox, QTabWidget, QListWidget, QFileSystemModel, \
-    QTreeView, QMenu
+    QTreeView, QMenu, QSpinBox, QListView, QStyledItemDelegate, QStyleOptionButton, QStyle, QAbstractItemView, \
+    QStyleOptionViewItem
 from PyQt5.QtWidgets import QListWidgetItem
-from PyQt5.QtGui import QFont, QPalette, QColor
-from PyQt5.QtCore import QThread, pyqtSignal
-from send2trash import send2trash
-
-# 配置日志记录
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+from PyQt5.QtGui import QFont, QPalette, QColor, QImage, QImageReader, QPixmap, QTransform
+from PyQt5.QtCore import QThread, pyqtSignal, QObject, QTimer, Qt, QAbstractListModel, QModelIndex, QRect, QSize, \
+    QEvent, QFileSystemWatcher, QBuffer, QByteArray, QIODevice
 
-# 读取配置文件
-config = configparser.ConfigParser()
-config.read('config.ini')
+from photoassistant_core import image_target_directory, video_target_directory, sd_card_directory, copy_workers, \
+    mirror_image_target_directory, mirror_video_target_directory, \
+    cleanup_trash_batch_size, cleanup_cross_device_mbps, benchmark_hashers, CardScanIndex, get_library_index, \
+    PathReservations, IngestJob, PairingIndex, merge_pairing_changes, PairingScan, device_of, cross_device_files, \
+    FileOperation, configure_logging, check_free_space, space_shortfall_message, preview_max_size, \
+    preview_memory_items, read_embedded_preview, PreviewDiskCache
 
-
-# 获取用户图片和视频文件夹路径
-def get_user_pictures_folder():
-    if os.name == 'nt':  # Windows 系统
-        return os.path.join(os.environ['USERPROFILE'], 'Pictures')
-    elif os.name == 'posix':  # macOS 或 Linux 系统
-        return os.path.join(str(Path.home()), 'Pictures')
-    return None
+# 配置日志记录
+configure_logging()
 
 
-def get_user_videos_folder():
-    if os.name == 'nt':  # Windows 系统
-        return os.path.join(os.environ['USERPROFILE'], 'Videos')
-    elif os.name == 'posix':  # macOS 或 Linux 系统
-        return os.path.join(str(Path.home()), 'Movies')
-    return None
+def startup_mark(name):
+    startup_marks.append((name, time.perf_counter() - STARTUP_TIME))
 
 
-# 获取用户桌面路径
-def get_user_desktop_folder():
-    if os.name == 'nt':  # Windows 系统
-        return os.path.join(os.environ['USERPROFILE'], 'Desktop')
-    elif os.name == 'posix':  # macOS 或 Linux 系统
-        return os.path.join(str(Path.home()), 'Desktop')
-    return None
+def report_startup_time():
+    startup_mark('首次显示窗口')
+    for name, elapsed in startup_marks:
+        print(f'{name:12s} {elapsed * 1000:8.1f} ms', file=sys.stderr)
 
 
-# 获取默认路径
-image_target_directory = config.get('Paths', 'image_target_directory', fallback=get_user_desktop_folder())
-video_target_directory = config.get('Paths', 'video_target_directory', fallback=get_user_desktop_folder())
-sd_card_directory = config.get('Paths', 'sd_card_directory', fallback='H:\\')
+def open_with_default_app(path):
+    """用系统默认程序打开文件或文件夹，不等待程序退出"""
+    if sys.platform.startswith('win'):
+        os.startfile(path)
+    else:
+        # 只有打开文件时才需要 subprocess，不在启动时导入
+        import subprocess
+        if sys.platform.startswith('darwin'):
+            subprocess.Popen(('open', path))
+        elif sys.platform.startswith('linux'):
+            subprocess.Popen(('xdg-open', path))
 
 
 class CopyThread(QThread):
+    """在后台线程中执行导入任务，参数与 IngestJob 相同"""
     progress_signal = pyqtSignal(int)
     result_signal = pyqtSignal(str)
 
-    def __init__(self, image_target, separate_mode, video_target, sd_card, event_name, selected_dates):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.job = IngestJob(*args, progress_callback=self.progress_signal.emit, **kwargs)
+
+    def run(self):
+        self.result_signal.emit(self.job.run())
+
+
+class PlanThread(QThread):
+    """在后台线程中为每张卡生成导入计划并检查目标磁盘空间，这一步不创建文件夹也不写入数据"""
+    # 卡路径 -> IngestPlan, 剩余空间不足的磁盘列表
+    plans_ready = pyqtSignal(object, object)
+
+    def __init__(self, cards, image_target, separate_mode, video_target, event_name, selected_dates,
+                 scan_indexes=None, mirror_targets=(None, None)):
         super().__init__()
-        self.image_target = image_target
-        self.separate_mode = separate_mode
-        self.video_target = video_target
-        self.sd_card = sd_card
+        self.cards = list(cards)
+        self.job_args = (image_target, separate_mode, video_target)
         self.event_name = event_name
         self.selected_dates = selected_dates
+        self.scan_indexes = scan_indexes or {}
+        # 镜像导入的图片和视频目录
+        self.mirror_targets = mirror_targets
+        # 按计划拷贝时继续使用这份目标路径分配表
+        self.reservations = PathReservations()
 
     def run(self):
-        # 定义图片文件的扩展名，包含更多 RAW 格式
-        image_extensions = (
-            '.jpg', '.jpeg', '.png', '.raw', '.nef', '.cr2', '.cr3',
-            '.arw',  # 索尼 RAW 格式
-            '.dng',  # 通用 RAW 格式
-            '.raf',  # 富士 RAW 格式
-            '.orf',  # 奥林巴斯 RAW 格式
-            '.pef',  # 宾得 RAW 格式
-            '.srw',  # 三星 RAW 格式
-            '.x3f'  # 适马 RAW 格式
-        )
-        video_extensions = ('.mp4', '.avi', '.mov')
-
-        all_files = []
-        for root, dirs, files in os.walk(self.sd_card):
-            logging.debug(f"Processing directory: {root}")
-            for file in files:
-                file_path = os.path.join(root, file)
-                all_files.append(file_path)
-                # 增加调试信息，输出每个文件的扩展名
-                file_ext = os.path.splitext(file)[1].lower()
-                logging.debug(f"Found file: {file}, extension: {file_ext}")
-
-        total_files = len(all_files)
-        copied_files = 0
-        created_folders = set()
-
-        if total_files == 0:
-            self.result_signal.emit("SD 卡目录中没有可用的图片或视频文件，请检查路径。")
-            return
+        image_target, separate_mode, video_target = self.job_args
+        plans = {}
+        for card in self.cards:
+            job = IngestJob(image_target, separate_mode, video_target, card, self.event_name, self.selected_dates,
+                            reservations=self.reservations, scan_index=self.scan_indexes.get(card),
+                            mirror_image_target=self.mirror_targets[0], mirror_video_target=self.mirror_targets[1])
+            plans[card] = job.make_plan()
+        self.plans_ready.emit(plans, check_free_space(list(plans.values())))
+
+
+class MultiCardCopyScheduler(QObject):
+    """多卡并行拷贝：位于同一物理设备上的卡依次拷贝，不同设备之间并行拷贝"""
+    # 卡路径, MetricsSnapshot（按字节的进度、当前和平均速度、剩余时间、是否卡住）
+    metrics_signal = pyqtSignal(str, object)
+    # 总进度百分比, 预计剩余秒数（无法估计时为 -1）
+    overall_progress_signal = pyqtSignal(int, float)
+    result_signal = pyqtSignal(str)
 
-        for file_path in all_files:
-            file = os.path.basename(file_path)
-            lower_file = file.lower()
-            is_image = False
-            is_video = False
-            for ext in image_extensions:
-                if lower_file.endswith(ext.lower()):
-                    is_image = True
-                    break
-            for ext in video_extensions:
-                if lower_file.endswith(ext.lower()):
-                    is_video = True
-                    break
-
-            if is_image or is_video:
-                try:
-                    date_taken = datetime.datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y%m%d')
-                    if self.selected_dates and date_taken not in self.selected_dates:
+    def __init__(self, cards, image_target, separate_mode, video_target, event_name, selected_dates,
+                 workers=copy_workers, scan_indexes=None, plans=None, reservations=None,
+                 mirror_targets=(None, None)):
+        super().__init__()
+        self.cards = list(cards)
+        self.thread_args = (image_target, separate_mode, video_target)
+        self.event_name = event_name
+        self.selected_dates = selected_dates
+        self.workers = workers
+        self.scan_indexes = scan_indexes or {}
+        # 事先生成的导入计划，没有时由各个拷贝任务自己生成
+        self.plans = plans or {}
+        self.mirror_targets = mirror_targets
+        # 所有卡共享同一份目标路径分配表，避免不同机身的同名文件互相覆盖
+        self.reservations = reservations or PathReservations()
+        self.lanes = {}
+        for card in self.cards:
+            self.lanes.setdefault(self.device_of(card), []).append(card)
+        self.pending = {device: list(cards) for device, cards in self.lanes.items()}
+        self.threads = {}
+        self.results = {}
+        self.timer = QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.report_progress)
+
+    @staticmethod
+    def device_of(path):
+        device = device_of(path)
+        return path if device is None else device
+
+    def start(self):
+        for device in self.lanes:
+            self.start_next(device)
+        self.timer.start()
+
+    def start_next(self, device):
+        if not self.pending[device]:
+            return
+        card = self.pending[device].pop(0)
+        image_target, separate_mode, video_target = self.thread_args
+        thread = CopyThread(image_target, separate_mode, video_target, card, self.event_name, self.selected_dates,
+                            workers=self.workers, reservations=self.reservations,
+                            scan_index=self.scan_indexes.get(card), plan=self.plans.get(card),
+                            mirror_image_target=self.mirror_targets[0], mirror_video_target=self.mirror_targets[1])
+        thread.result_signal.connect(self.on_card_finished)
+        self.threads[card] = thread
+        logging.info("Start copying card %s", card)
+        thread.start()
+
+    def on_card_finished(self, result):
+        card = next(c for c, t in self.threads.items() if t is self.sender())
+        self.results[card] = result
+        self.start_next(self.device_of(card))
+        if len(self.results) == len(self.cards):
+            self.timer.stop()
+            self.report_progress()
+            self.result_signal.emit('\n'.join(f'{c}: {self.results[c]}' for c in self.cards))
+
+    def planned_bytes(self, card):
+        """还没有开始拷贝的卡的总字节数：优先使用导入计划，其次使用扫描结果，都没有时返回 None"""
+        plan = self.plans.get(card)
+        if plan is not None:
+            return plan.total_bytes()
+        scan_index = self.scan_indexes.get(card)
+        if scan_index is not None:
+            return sum(entry.size for entry in scan_index.entries)
+        return None
+
+    def report_progress(self):
+        total_bytes = 0
+        done_bytes = 0
+        eta = 0.0
+        eta_unknown = False
+        for device, cards in self.lanes.items():
+            lane_remaining = 0
+            lane_rate = 0.0
+            for card in cards:
+                thread = self.threads.get(card)
+                if thread is None or thread.job.metrics.start_time is None:
+                    if card in self.results:
+                        # 没有开始拷贝就结束了（例如生成计划时出错）
                         continue
-                except Exception as e:
-                    logging.error(f"Failed to get modification time for {file}: {e}")
-                    continue
-
-                if is_image:
-                    target_dir = self.image_target
-                    logging.debug(f"File {file} identified as an image.")
-                elif is_video:
-                    target_dir = self.video_target
-                    logging.debug(f"File {file} identified as a video.")
-
-                logging.debug(f"Processing file: {file}")
-
-                # 创建包含活动名称的文件夹
-                folder_name = f'{date_taken}_{self.event_name}'
-                folder_path = os.path.join(target_dir, folder_name)
-                if folder_path not in created_folders:
-                    if not os.path.exists(folder_path):
-                        try:
-                            os.makedirs(folder_path)
-                            logging.info(f"Created folder: {folder_path}")
-                        except Exception as e:
-                            logging.error(f"Failed to create folder {folder_path}: {e}")
-                            continue
-                    created_folders.add(folder_path)
-
-                # 处理文件名重复情况（修改目标子文件夹路径）
-                new_file_name = file
-                if is_image and self.separate_mode:
-                    # 根据图片格式确定目标子文件夹
-                    file_ext = os.path.splitext(file)[1].lower()
-                    jpg_extensions = ('.jpg', '.jpeg', '.png')
-                    raw_extensions = (
-                    '.raw', '.nef', '.cr2', '.cr3', '.arw', '.dng', '.raf', '.orf', '.pef', '.srw', '.x3f')
-
-                    if file_ext in jpg_extensions:
-                        target_subfolder = os.path.join(folder_path, 'JPG')
-                    elif file_ext in raw_extensions:
-                        target_subfolder = os.path.join(folder_path, 'RAW')
+                    # 排队中的卡按导入计划的总大小计入，总进度不会在下一张卡开始时倒退，剩余时间也包括排队的卡
+                    card_bytes = self.planned_bytes(card)
+                    if card_bytes is None:
+                        eta_unknown = True
                     else:
-                        # 非 JPG 和 RAW 格式，可根据需求处理，这里暂时放在主文件夹
-                        target_subfolder = folder_path
+                        total_bytes += card_bytes
+                        lane_remaining += card_bytes
+                    continue
+                metrics = thread.job.metrics.snapshot()
+                self.metrics_signal.emit(card, metrics)
+                total_bytes += metrics.total_bytes
+                done_bytes += metrics.done_bytes
+                if card not in self.results:
+                    lane_remaining += metrics.total_bytes - metrics.done_bytes
+                    lane_rate = (metrics.current_mbps or metrics.average_mbps) * 1024 * 1024
+                elif not lane_rate:
+                    # 下一张卡刚排上还没有速度时，按同一设备上已经拷贝完的卡的平均速度估计
+                    lane_rate = metrics.average_mbps * 1024 * 1024
+            # 同一设备上的卡依次拷贝，总耗时取决于最慢的一条设备通道
+            if lane_remaining:
+                if lane_rate:
+                    eta = max(eta, lane_remaining / lane_rate)
                 else:
-                    target_subfolder = folder_path  # 视频文件或不勾选时直接放主文件夹
-
-                if is_image and self.separate_mode:
-                    if not os.path.exists(target_subfolder):
-                        try:
-                            os.makedirs(target_subfolder)
-                            logging.info(f"Created subfolder: {target_subfolder}")
-                        except Exception as e:
-                            logging.error(f"Failed to create subfolder {target_subfolder}: {e}")
-
-                new_file_path = os.path.join(target_subfolder, new_file_name)
-                counter = 1
-                while os.path.exists(new_file_path):
-                    base_name, ext = os.path.splitext(file)
-                    new_file_name = f'{base_name}_{counter}{ext}'
-                    new_file_path = os.path.join(target_subfolder, new_file_name)
-                    counter += 1
-
-                # 拷贝文件并进行哈希校验
-                try:
-                    logging.info(f"Copying {file} to {new_file_path}")
-                    shutil.copy2(file_path, new_file_path)
-                    with open(file_path, 'rb') as f1, open(new_file_path, 'rb') as f2:
-                        hash1 = hashlib.sha256(f1.read()).hexdigest()
-                        hash2 = hashlib.sha256(f2.read()).hexdigest()
-                        if hash1 != hash2:
-                            logging.error(f'哈希校验失败: {file}')
-                        else:
-                            logging.info(f'成功拷贝: {file}')
-                except Exception as e:
-                    logging.error(f'拷贝文件时出错: {file}, 错误信息: {e}')
-
-            copied_files += 1
-            progress = int((copied_files / total_files) * 100)
-            self.progress_signal.emit(progress)
-
-        # 确保进度条达到 100%
-        self.progress_signal.emit(100)
+                    eta_unknown = True
+        overall = int(done_bytes * 100 / total_bytes) if total_bytes else 0
+        self.overall_progress_signal.emit(overall, -1.0 if eta_unknown else eta)
 
-        result_msg = f"拷贝完成，生成的文件夹有：{', '.join(created_folders)}"
-        self.result_signal.emit(result_msg)
+
+class LibraryScanThread(QThread):
+    """扫描目标目录中已有的文件，建立图库内容哈希索引，供拷贝时查重"""
+    progress_signal = pyqtSignal(int)
+    result_signal = pyqtSignal(str)
+
+    def __init__(self, library_roots, workers=min(8, os.cpu_count() or 4)):
+        super().__init__()
+        roots = {}
+        for root in library_roots:
+            if root and os.path.isdir(root):
+                roots.setdefault(os.path.normcase(os.path.abspath(root)), root)
+        self.library_roots = list(roots.values())
+        self.workers = workers
+
+    def run(self):
+        indexed = 0
+        for library_root in self.library_roots:
+            logging.info("Indexing library %s", library_root)
+            indexed += get_library_index(library_root).bootstrap(
+                self.workers, lambda done, total: self.progress_signal.emit(int(done * 100 / total)))
+        self.progress_signal.emit(100)
+        self.result_signal.emit(f"图库扫描完成，新建索引的文件 {indexed} 个")
 
 
 # 修改基类为 QTreeView
@@ -227,20 +259,260 @@ class CustomTreeView(QTreeView):
 
     def open_path_in_file_manager(self, path):
         try:
-            if sys.platform.startswith('win'):
-                os.startfile(path)
-            elif sys.platform.startswith('darwin'):
-                subprocess.call(('open', path))
-            elif sys.platform.startswith('linux'):
-                subprocess.call(('xdg-open', path))
+            open_with_default_app(path)
         except Exception as e:
             print(f"打开 {path} 时出错: {e}")
 
 
+class UnmatchedRawModel(QAbstractListModel):
+    """没有同名 JPG 的 RAW 文件列表，只保存路径，由视图按需绘制可见的行"""
+
+    def __init__(self):
+        super().__init__()
+        self.paths = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role in (Qt.ToolTipRole, Qt.UserRole):
+            return path
+        return None
+
+    def set_paths(self, paths):
+        self.beginResetModel()
+        self.paths = list(paths)
+        self.endResetModel()
+
+    def add_paths(self, paths):
+        if not paths:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.paths), len(self.paths) + len(paths) - 1)
+        self.paths.extend(paths)
+        self.endInsertRows()
+
+    def remove_paths(self, paths):
+        """删除指定路径对应的行，连续的行合并成一次删除"""
+        paths = set(paths)
+        rows = [row for row, path in enumerate(self.paths) if path in paths]
+        # 从后往前删除，前面的行号不受影响
+        while rows:
+            last = rows.pop()
+            first = last
+            while rows and rows[-1] == first - 1:
+                first = rows.pop()
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.paths[first:last + 1]
+            self.endRemoveRows()
+
+
+class RawItemDelegate(QStyledItemDelegate):
+    """在每一行右侧绘制“查看”按钮，点击按钮时发出 view_requested 信号"""
+    view_requested = pyqtSignal(str)
+    button_width = 60
+
+    def button_rect(self, option):
+        rect = option.rect
+        return QRect(rect.right() - self.button_width, rect.top() + 2, self.button_width - 4, rect.height() - 4)
+
+    def paint(self, painter, option, index):
+        # 文字部分让出按钮的位置，避免长文件名被按钮遮挡
+        text_option = QStyleOptionViewItem(option)
+        text_option.rect = option.rect.adjusted(0, 0, -self.button_width, 0)
+        super().paint(painter, text_option, index)
+        button = QStyleOptionButton()
+        button.rect = self.button_rect(option)
+        button.text = '查看'
+        button.state = QStyle.State_Enabled
+        QApplication.style().drawControl(QStyle.CE_PushButton, button, painter)
+
+    def sizeHint(self, option, index):
+        size = super().sizeHint(option, index)
+        return QSize(size.width() + self.button_width, max(size.height(), 28))
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and self.button_rect(option).contains(event.pos()):
+            self.view_requested.emit(index.data(Qt.UserRole))
+            return True
+        return super().editorEvent(event, model, option, index)
+
+
+# EXIF 方向 -> 需要顺时针旋转的角度（镜像的方向很少见，不处理）
+ORIENTATION_ANGLES = {3: 180, 6: 90, 8: 270}
+
+
+class PreviewLoader(QObject):
+    """在线程池中提取并解码 RAW 文件的内嵌预览图
+
+    解码后的图片在内存中按 LRU 保留最近的几十张，缩放后的 JPEG 同时写入磁盘缓存，
+    再次打开同一个文件夹时不需要重新读取 RAW 文件。
+    """
+    # 文件路径, QImage（没有找到预览图时为空的 QImage）
+    preview_ready = pyqtSignal(str, object)
+
+    def __init__(self, max_size=preview_max_size, memory_items=preview_memory_items, workers=2):
+        super().__init__()
+        self.max_size = max_size
+        self.memory_items = memory_items
+        # 路径 -> QImage，只在界面线程中读写
+        self.memory = OrderedDict()
+        self.disk_cache = PreviewDiskCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # 已经提交但还没有完成的路径，以及当前仍然需要的路径
+        self.pending = set()
+        self.wanted = set()
+        # 先于其它连接执行，界面收到图片时内存缓存中已经有了这张图
+        self.preview_ready.connect(self.remember)
+
+    def cached(self, path):
+        image = self.memory.get(path)
+        if image is not None:
+            self.memory.move_to_end(path)
+        return image
+
+    def request(self, paths):
+        """依次加载 paths 中的预览图，第一张是当前要显示的，其余的是预读；翻页很快时跳过已经不需要的旧请求"""
+        with self.lock:
+            self.wanted = set(paths)
+            paths = [path for path in paths if path not in self.memory and path not in self.pending]
+            self.pending.update(paths)
+        for path in paths:
+            self.executor.submit(self.load, path)
+
+    def forget(self, paths):
+        for path in paths:
+            self.memory.pop(path, None)
+
+    def remember(self, path, image):
+        self.memory[path] = image
+        self.memory.move_to_end(path)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def load(self, path):
+        with self.lock:
+            wanted = path in self.wanted
+        image = None
+        if wanted:
+            try:
+                image = self.decode(path)
+            except Exception as e:
+                logging.error("读取预览图失败: %s, 错误信息: %s", path, e)
+                image = QImage()
+        with self.lock:
+            self.pending.discard(path)
+        if image is not None:
+            self.preview_ready.emit(path, image)
+
+    def decode(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return QImage()
+        data = self.disk_cache.get(path, stat.st_size, stat.st_mtime)
+        if data is not None:
+            image = QImage.fromData(data, 'JPG')
+            if not image.isNull():
+                return image
+        preview = read_embedded_preview(path)
+        if preview is None:
+            return QImage()
+        data, orientation = preview
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer, b'jpg')
+        # RAW 文件记录了方向时以 RAW 为准，内嵌 JPEG 自身的 EXIF 方向往往没有设置
+        reader.setAutoTransform(orientation is None)
+        # 解码时直接缩小，JPEG 可以跳过大部分 DCT 计算，比解码整张图再缩放快得多
+        size = reader.size()
+        if size.isValid() and max(size.width(), size.height()) > self.max_size:
+            reader.setScaledSize(size.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return image
+        if orientation in ORIENTATION_ANGLES:
+            image = image.transformed(QTransform().rotate(ORIENTATION_ANGLES[orientation]))
+        output = QBuffer()
+        output.open(QIODevice.WriteOnly)
+        if image.save(output, 'JPG', 85):
+            self.disk_cache.put(path, stat.st_size, stat.st_mtime, bytes(output.data()))
+        return image
+
+
+class CleanupScanThread(QThread):
+    """在后台线程中执行 PairingScan，边扫描边分批发送结果"""
+    # 新发现的未匹配 RAW 路径
+    unmatched_added = pyqtSignal(list)
+    # 后来找到了同名 JPG、不再是未匹配的 RAW 路径
+    unmatched_removed = pyqtSignal(list)
+    # JPG 数量, RAW 数量
+    counts_changed = pyqtSignal(int, int)
+    scan_finished = pyqtSignal(bool)
+
+    def __init__(self, path):
+        super().__init__()
+        self.scan = PairingScan(path, self.unmatched_added.emit, self.unmatched_removed.emit, self.counts_changed.emit)
+        self.index = self.scan.index
+        # 扫描过的所有文件夹，扫描结束后用来监视文件变化
+        self.directories = self.scan.directories
+
+    def cancel(self):
+        self.scan.cancel()
+
+    def run(self):
+        self.scan_finished.emit(self.scan.run())
+
+
+class FileOperationThread(QThread):
+    """在后台线程中执行 FileOperation，参数与 FileOperation 相同"""
+    progress_signal = pyqtSignal(int)
+    # 已经处理成功的文件路径，分批发送
+    files_done = pyqtSignal(list)
+    # 文件路径, 错误信息
+    error_signal = pyqtSignal(str, str)
+    result_signal = pyqtSignal(str)
+
+    def __init__(self, operation, paths, target_dir=None, trash_batch_size=cleanup_trash_batch_size):
+        super().__init__()
+        self.operation = FileOperation(operation, paths, target_dir, trash_batch_size, self.progress_signal.emit,
+                                       self.files_done.emit, self.error_signal.emit)
+
+    def cancel(self):
+        self.operation.cancel()
+
+    def run(self):
+        self.result_signal.emit(self.operation.run())
+
+
 class FileBrowserTab(QWidget):
     def __init__(self):
         super().__init__()
         self.selected_dir = ""
+        self.scan_thread = None
+        self.pairing_index = PairingIndex()
+        # 扫描结束后监视扫描过的文件夹，在其它软件中删除或添加文件时只刷新发生变化的文件夹
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_watched_directory_changed)
+        self.changed_dirs = set()
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(300)
+        self.refresh_timer.timeout.connect(self.refresh_changed_directories)
+        self.operation_thread = None
+        self.operation_errors = []
+        # 已取消但还没有结束的扫描线程，需要保留引用直到线程退出
+        self.retired_scan_threads = []
+        self.preview_loader = PreviewLoader()
+        self.preview_loader.preview_ready.connect(self.on_preview_ready)
+        self.preview_path = None
+        self.preview_image = None
         self.initUI()
 
     def initUI(self):
@@ -283,15 +555,35 @@ class FileBrowserTab(QWidget):
 
         # 右侧显示信息
         self.jpg_count_label = QLabel("JPG 文件数量: 0")
-        self.cr3_count_label = QLabel("CR3 文件数量: 0")
-        self.unmatched_cr3_list = QListWidget()
-        self.unmatched_cr3_label = QLabel("没有同名 JPG 文件的 CR3 文件")
+        self.raw_count_label = QLabel("RAW 文件数量: 0")
+        # 使用模型/视图显示列表，几万行时也只绘制可见的部分
+        self.unmatched_model = UnmatchedRawModel()
+        self.unmatched_delegate = RawItemDelegate()
+        self.unmatched_delegate.view_requested.connect(self.view_single_raw_file)
+        self.unmatched_raw_list = QListView()
+        self.unmatched_raw_list.setModel(self.unmatched_model)
+        self.unmatched_raw_list.setItemDelegate(self.unmatched_delegate)
+        self.unmatched_raw_list.setUniformItemSizes(True)
+        self.unmatched_raw_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.unmatched_raw_label = QLabel("没有同名 JPG 文件的 RAW 文件")
         # 增加列表高度
-        self.unmatched_cr3_list.setMinimumHeight(300)
+        self.unmatched_raw_list.setMinimumHeight(300)
+        # 用方向键在列表中切换时预览当前的 RAW 文件
+        self.unmatched_raw_list.selectionModel().currentChanged.connect(self.on_current_raw_changed)
+        # 删除/移动按钮的文字随选中的行数变化，让用户知道会处理哪些文件
+        self.unmatched_raw_list.selectionModel().selectionChanged.connect(self.update_operation_labels)
+        self.unmatched_model.modelReset.connect(self.update_operation_labels)
+        self.unmatched_model.rowsRemoved.connect(self.update_operation_labels)
+
+        # RAW 文件内嵌的预览图
+        self.preview_name_label = QLabel()
+        self.preview_label = QLabel("选择列表中的 RAW 文件查看预览")
+        self.preview_label.setAlignment(Qt.AlignCenter)
+        self.preview_label.setMinimumSize(480, 320)
 
         # 删除按钮
-        self.delete_button = QPushButton("删除不存在同名 JPG 的 CR3 文件")
-        self.delete_button.clicked.connect(self.delete_unmatched_cr3_files)
+        self.delete_button = QPushButton("删除不存在同名 JPG 的 RAW 文件")
+        self.delete_button.clicked.connect(self.delete_unmatched_raw_files)
         # 增大按钮高度和字体
         self.delete_button.setMinimumHeight(40)
         self.delete_button.setFont(QFont('Microsoft YaHei', 12))
@@ -327,9 +619,22 @@ class FileBrowserTab(QWidget):
 
         # 执行剪切操作按钮
         self.cut_button = QPushButton("移动到所选目录")
-        self.cut_button.clicked.connect(self.cut_unmatched_cr3_files)
+        self.cut_button.clicked.connect(self.cut_unmatched_raw_files)
         # 增加按钮高度
         self.cut_button.setMinimumHeight(30)
+        self.update_operation_labels()
+
+        # 删除/移动的进度和取消按钮
+        self.operation_progress = QProgressBar()
+        self.operation_progress.setValue(0)
+        self.cancel_operation_button = QPushButton("取消")
+        self.cancel_operation_button.setEnabled(False)
+        self.cancel_operation_button.clicked.connect(self.cancel_operation)
+        self.operation_label = QLabel()
+        self.operation_label.setWordWrap(True)
+        operation_layout = QHBoxLayout()
+        operation_layout.addWidget(self.operation_progress)
+        operation_layout.addWidget(self.cancel_operation_button)
 
         # 打开所选路径按钮
         self.open_selected_dir_button = QPushButton("打开目标目录")
@@ -349,19 +654,26 @@ class FileBrowserTab(QWidget):
 
         right_layout = QVBoxLayout()
         right_layout.addWidget(self.jpg_count_label)
-        right_layout.addWidget(self.cr3_count_label)
-        right_layout.addWidget(self.unmatched_cr3_label)
-        right_layout.addWidget(self.unmatched_cr3_list)
+        right_layout.addWidget(self.raw_count_label)
+        right_layout.addWidget(self.unmatched_raw_label)
+        right_layout.addWidget(self.unmatched_raw_list)
         right_layout.addWidget(self.delete_button)
         right_layout.addWidget(self.select_dir_button)
         right_layout.addWidget(self.selected_dir_label)
 
         right_layout.addWidget(self.cut_button)
         right_layout.addWidget(self.open_selected_dir_button)
+        right_layout.addLayout(operation_layout)
+        right_layout.addWidget(self.operation_label)
+
+        preview_layout = QVBoxLayout()
+        preview_layout.addWidget(self.preview_name_label)
+        preview_layout.addWidget(self.preview_label, 1)
 
         main_layout = QHBoxLayout()
         main_layout.addLayout(left_layout)
         main_layout.addLayout(right_layout)
+        main_layout.addLayout(preview_layout, 1)
 
         self.setLayout(main_layout)
 
@@ -374,108 +686,260 @@ class FileBrowserTab(QWidget):
 
     def on_directory_clicked(self, index):
         path = self.file_system_model.filePath(index)
-        self.unmatched_cr3_list.clear()
-
-        jpg_files = []
-        cr3_files = []
-
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.lower().endswith('.jpg'):
-                    jpg_files.append(os.path.join(root, file))
-                elif file.lower().endswith('.cr3'):
-                    cr3_files.append(os.path.join(root, file))
-
-        jpg_names = set([os.path.splitext(os.path.basename(jpg))[0] for jpg in jpg_files])
-        unmatched_cr3 = []
-        for cr3 in cr3_files:
-            cr3_name = os.path.splitext(os.path.basename(cr3))[0]
-            if cr3_name not in jpg_names:
-                unmatched_cr3.append(cr3)
-
-        self.jpg_count_label.setText(f"JPG 文件数量: {len(jpg_files)}")
-        self.cr3_count_label.setText(f"CR3 文件数量: {len(cr3_files)}")
-
-        for cr3 in unmatched_cr3:
-            if os.path.exists(cr3):  # 检查文件路径是否存在
-                item = QListWidgetItem()
-                widget = QWidget()
-                layout = QHBoxLayout()
-                layout.setContentsMargins(0, 0, 0, 0)
-                file_name = os.path.basename(cr3)
-                label = QLabel(file_name)
-                view_button = QPushButton("查看")
-                view_button.clicked.connect(lambda _, p=cr3: self.view_single_cr3_file(p))
-                layout.addWidget(label)
-                layout.addWidget(view_button)
-
-                widget.setLayout(layout)
-                item.setSizeHint(widget.sizeHint())
-                self.unmatched_cr3_list.addItem(item)
-                self.unmatched_cr3_list.setItemWidget(item, widget)
-            else:
-                logging.warning(f"文件路径不存在: {cr3}")
-
-    def view_single_cr3_file(self, cr3_path):
-        if os.path.exists(cr3_path):  # 检查文件路径是否存在
+
+        # 点击其它目录时取消之前的扫描
+        if self.scan_thread is not None and self.scan_thread.isRunning():
+            self.scan_thread.cancel()
+            self.scan_thread.finished.connect(self.release_scan_threads)
+            self.retired_scan_threads.append(self.scan_thread)
+
+        self.stop_watching()
+        self.unmatched_model.set_paths([])
+        self.show_preview(None)
+        # 扫描完成前列表中的 RAW 之后可能还会找到对应的 JPG，扫描结束后才允许删除或移动
+        self.delete_button.setEnabled(False)
+        self.cut_button.setEnabled(False)
+        self.jpg_count_label.setText("JPG 文件数量: 0")
+        self.raw_count_label.setText("RAW 文件数量: 0")
+        self.unmatched_raw_label.setText("没有同名 JPG 文件的 RAW 文件（扫描中…）")
+
+        self.scan_thread = CleanupScanThread(path)
+        self.pairing_index = self.scan_thread.index
+        self.scan_thread.unmatched_added.connect(self.on_unmatched_added)
+        self.scan_thread.unmatched_removed.connect(self.on_unmatched_removed)
+        self.scan_thread.counts_changed.connect(self.on_counts_changed)
+        self.scan_thread.scan_finished.connect(self.on_scan_finished)
+        self.scan_thread.start()
+
+    def release_scan_threads(self):
+        self.retired_scan_threads = [thread for thread in self.retired_scan_threads if thread.isRunning()]
+
+    # 已取消的扫描线程可能还有排队中的信号，只处理当前扫描线程发出的结果
+    def on_unmatched_added(self, paths):
+        if self.sender() is self.scan_thread:
+            self.unmatched_model.add_paths(paths)
+
+    def on_unmatched_removed(self, paths):
+        if self.sender() is self.scan_thread:
+            self.unmatched_model.remove_paths(paths)
+
+    def on_counts_changed(self, jpg_count, raw_count):
+        if self.sender() is self.scan_thread:
+            self.jpg_count_label.setText(f"JPG 文件数量: {jpg_count}")
+            self.raw_count_label.setText(f"RAW 文件数量: {raw_count}")
+
+    def on_scan_finished(self, completed):
+        if self.sender() is self.scan_thread and completed:
+            self.unmatched_raw_label.setText("没有同名 JPG 文件的 RAW 文件")
+            if self.operation_thread is None or not self.operation_thread.isRunning():
+                self.delete_button.setEnabled(True)
+                self.cut_button.setEnabled(True)
+            self.watch_directories(self.scan_thread.directories)
+
+    def watch_directories(self, directories):
+        if directories:
+            failed = self.watcher.addPaths(directories)
+            if failed:
+                logging.warning("无法监视 %s 个文件夹的变化", len(failed))
+
+    def stop_watching(self):
+        watched = self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+        self.changed_dirs.clear()
+        self.refresh_timer.stop()
+
+    def unwatch_tree(self, directory):
+        directory = os.path.normpath(directory)
+        prefix = os.path.join(directory, '')
+        paths = [path for path in self.watcher.directories()
+                 if os.path.normpath(path) == directory or os.path.normpath(path).startswith(prefix)]
+        if paths:
+            self.watcher.removePaths(paths)
+
+    def on_watched_directory_changed(self, path):
+        # 批量删除时会连续收到很多通知，稍等一下合并处理
+        self.changed_dirs.add(path)
+        self.refresh_timer.start()
+
+    def refresh_changed_directories(self):
+        changes = []
+        pending = sorted(self.changed_dirs)
+        self.changed_dirs.clear()
+        watched = {os.path.normpath(path) for path in self.watcher.directories()}
+        while pending:
+            directory = pending.pop()
+            if not os.path.isdir(directory):
+                self.unwatch_tree(directory)
+                changes.append(self.pairing_index.remove_tree(directory))
+                continue
             try:
-                if sys.platform.startswith('win'):
-                    os.startfile(cr3_path)
-                elif sys.platform.startswith('darwin'):
-                    subprocess.call(('open', cr3_path))
-                elif sys.platform.startswith('linux'):
-                    subprocess.call(('xdg-open', cr3_path))
+                added, removed, sub_dirs = self.pairing_index.refresh_directory(directory)
+            except OSError as e:
+                logging.error("Failed to refresh directory %s: %s", directory, e)
+                continue
+            changes.append((added, removed))
+            # 已经不存在的子文件夹（删除或移走）
+            current_dirs = {os.path.normpath(sub_dir) for sub_dir in sub_dirs}
+            for path in [path for path in watched if os.path.dirname(path) == os.path.normpath(directory)]:
+                if path not in current_dirs:
+                    self.unwatch_tree(path)
+                    changes.append(self.pairing_index.remove_tree(path))
+                    watched.discard(path)
+            # 新出现的子文件夹也加入监视并读取其中的文件
+            new_dirs = [sub_dir for sub_dir in sub_dirs if os.path.normpath(sub_dir) not in watched]
+            self.watch_directories(new_dirs)
+            watched.update(os.path.normpath(sub_dir) for sub_dir in new_dirs)
+            pending.extend(new_dirs)
+        added, removed = merge_pairing_changes(changes)
+        listed = set(self.unmatched_model.paths)
+        self.unmatched_model.remove_paths(removed)
+        self.forget_previews(removed)
+        self.unmatched_model.add_paths([path for path in added if path not in listed])
+        self.jpg_count_label.setText(f"JPG 文件数量: {self.pairing_index.preview_count}")
+        self.raw_count_label.setText(f"RAW 文件数量: {self.pairing_index.raw_count}")
+
+    def target_paths(self):
+        """返回要处理的文件路径：列表中有选中的行时只处理选中的行，否则处理全部"""
+        rows = self.unmatched_raw_list.selectionModel().selectedRows()
+        if not rows:
+            return list(self.unmatched_model.paths)
+        return [self.unmatched_model.data(index, Qt.UserRole) for index in rows]
+
+    def update_operation_labels(self, *args):
+        count = len(self.unmatched_raw_list.selectionModel().selectedRows())
+        if count:
+            self.delete_button.setText(f"删除选中的 {count} 个 RAW 文件")
+            self.cut_button.setText(f"移动选中的 {count} 个文件到所选目录")
+        else:
+            self.delete_button.setText("删除不存在同名 JPG 的 RAW 文件")
+            self.cut_button.setText("移动到所选目录")
+
+    # 预读当前行之后的几张，逐张翻看时下一张通常已经解码好了
+    preview_prefetch = 3
+
+    def on_current_raw_changed(self, current, previous):
+        if not current.isValid():
+            self.show_preview(None)
+            return
+        row = current.row()
+        paths = self.unmatched_model.paths[row:row + 1 + self.preview_prefetch]
+        if row > 0:
+            paths.append(self.unmatched_model.paths[row - 1])
+        self.show_preview(paths[0], self.preview_loader.cached(paths[0]))
+        self.preview_loader.request(paths)
+
+    def on_preview_ready(self, path, image):
+        if path == self.preview_path:
+            self.show_preview(path, image)
+
+    def show_preview(self, path, image=None):
+        self.preview_path = path
+        self.preview_image = image
+        self.preview_name_label.setText(os.path.basename(path) if path else "")
+        if path is None:
+            self.preview_label.setText("选择列表中的 RAW 文件查看预览")
+        elif image is None:
+            self.preview_label.setText("正在读取预览…")
+        elif image.isNull():
+            self.preview_label.setText("这个文件中没有可以显示的内嵌预览图")
+        else:
+            pixmap = QPixmap.fromImage(image)
+            self.preview_label.setPixmap(pixmap.scaled(self.preview_label.size(), Qt.KeepAspectRatio,
+                                                       Qt.SmoothTransformation))
+
+    def forget_previews(self, paths):
+        self.preview_loader.forget(paths)
+        if self.preview_path in paths:
+            self.show_preview(None)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.preview_image is not None and not self.preview_image.isNull():
+            self.show_preview(self.preview_path, self.preview_image)
+
+    def view_single_raw_file(self, raw_path):
+        if os.path.exists(raw_path):  # 检查文件路径是否存在
+            try:
+                open_with_default_app(raw_path)
             except Exception as e:
-                print(f"打开 {cr3_path} 时出错: {e}")
+                print(f"打开 {raw_path} 时出错: {e}")
         else:
-            logging.warning(f"文件路径不存在: {cr3_path}")
+            logging.warning("文件路径不存在: %s", raw_path)
 
-    def cut_unmatched_cr3_files(self):
+    def cut_unmatched_raw_files(self):
         if not self.selected_dir:
             print("未选择目标目录")
             return
-        for i in range(self.unmatched_cr3_list.count()):
-            item = self.unmatched_cr3_list.item(i)
-            widget = self.unmatched_cr3_list.itemWidget(item)
-            label = widget.findChild(QLabel)
-            file_name = label.text()
-            current_path = self.file_system_model.filePath(self.tree_view.currentIndex())
-            for root, dirs, files in os.walk(current_path):
-                if file_name in files:
-                    cr3_path = os.path.join(root, file_name)
-                    if os.path.exists(cr3_path):  # 检查文件路径是否存在
-                        new_path = os.path.join(self.selected_dir, file_name)
-                        try:
-                            shutil.move(cr3_path, new_path)
-                            print(f"已剪切到新目录: {cr3_path} -> {new_path}")
-                        except Exception as e:
-                            print(f"剪切 {cr3_path} 时出错: {e}")
-                    else:
-                        logging.warning(f"文件路径不存在: {cr3_path}")
-        self.on_directory_clicked(self.tree_view.currentIndex())
-
-    def delete_unmatched_cr3_files(self):
-        for i in range(self.unmatched_cr3_list.count()):
-            item = self.unmatched_cr3_list.item(i)
-            widget = self.unmatched_cr3_list.itemWidget(item)
-            label = widget.findChild(QLabel)
-            file_name = label.text()
-            current_path = self.file_system_model.filePath(self.tree_view.currentIndex())
-            for root, dirs, files in os.walk(current_path):
-                if file_name in files:
-                    cr3_path = os.path.join(root, file_name)
-                    # 使用原始字符串处理路径
-                    cr3_path = os.path.normpath(cr3_path)
-                    print(f"准备删除: {cr3_path}")
-                    if os.path.exists(cr3_path):  # 检查文件路径是否存在
-                        try:
-                            send2trash(cr3_path)
-                            print(f"已删除到回收站: {cr3_path}")
-                        except Exception as e:
-                            print(f"删除 {cr3_path} 时出错: {e}")
-                    else:
-                        logging.warning(f"文件路径不存在: {cr3_path}")
-        self.on_directory_clicked(self.tree_view.currentIndex())
+        self.start_operation(FileOperation.OP_MOVE, self.selected_dir)
+
+    def delete_unmatched_raw_files(self):
+        self.start_operation(FileOperation.OP_TRASH)
+
+    def start_operation(self, operation, target_dir=None):
+        """直接使用扫描时得到的路径批量处理文件，只处理列表中的文件，不再重新遍历目录"""
+        if self.operation_thread is not None and self.operation_thread.isRunning():
+            return
+        paths = self.target_paths()
+        if not paths:
+            return
+        # 附属文件（XMP 等）和 RAW 文件一起处理
+        paths += [sidecar for path in paths for sidecar in self.pairing_index.sidecars_for(path)]
+        if operation == FileOperation.OP_MOVE and not self.confirm_cross_device_move(paths, target_dir):
+            return
+        self.operation_errors = []
+        self.operation_progress.setValue(0)
+        self.operation_label.setText("")
+        self.delete_button.setEnabled(False)
+        self.cut_button.setEnabled(False)
+        self.cancel_operation_button.setEnabled(True)
+        self.operation_thread = FileOperationThread(operation, paths, target_dir)
+        self.operation_thread.progress_signal.connect(self.operation_progress.setValue)
+        self.operation_thread.files_done.connect(self.on_files_done)
+        self.operation_thread.error_signal.connect(self.on_operation_error)
+        self.operation_thread.result_signal.connect(self.on_operation_finished)
+        self.operation_thread.start()
+
+    def confirm_cross_device_move(self, paths, target_dir):
+        """目标目录在另一个磁盘上时，移动需要完整拷贝文件，先提示预计耗时"""
+        files, total_bytes = cross_device_files(paths, target_dir)
+        if not files:
+            return True
+        total_mb = total_bytes / (1024 * 1024)
+        seconds = total_mb / cleanup_cross_device_mbps if cleanup_cross_device_mbps > 0 else 0
+        reply = QMessageBox.question(
+            self, "跨磁盘移动",
+            f"目标目录与 {len(files)} 个文件不在同一个磁盘上，需要拷贝 {total_mb:.0f} MB 后再删除源文件，"
+            f"按 {cleanup_cross_device_mbps:.0f} MB/s 估算约需 {seconds:.0f} 秒。\n\n是否继续？",
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        return reply == QMessageBox.Yes
+
+    def cancel_operation(self):
+        if self.operation_thread is not None:
+            self.operation_thread.cancel()
+
+    def on_files_done(self, paths):
+        for path in paths:
+            self.pairing_index.remove(path)
+        self.unmatched_model.remove_paths(paths)
+        self.forget_previews(set(paths))
+        self.jpg_count_label.setText(f"JPG 文件数量: {self.pairing_index.preview_count}")
+        self.raw_count_label.setText(f"RAW 文件数量: {self.pairing_index.raw_count}")
+
+    def on_operation_error(self, path, message):
+        self.operation_errors.append(f"{path}: {message}")
+
+    def on_operation_finished(self, result):
+        if self.scan_thread is None or not self.scan_thread.isRunning():
+            self.delete_button.setEnabled(True)
+            self.cut_button.setEnabled(True)
+        self.cancel_operation_button.setEnabled(False)
+        self.operation_label.setText(result)
+        if self.operation_errors:
+            details = "\n".join(self.operation_errors[:20])
+            if len(self.operation_errors) > 20:
+                details += f"\n……共 {len(self.operation_errors)} 个错误"
+            QMessageBox.warning(self, "部分文件处理失败", details)
 
     def select_target_directory(self):
         directory = QFileDialog.getExistingDirectory(self, "选择目标目录")
@@ -487,12 +951,7 @@ class FileBrowserTab(QWidget):
     def open_selected_directory(self):
         if self.selected_dir and os.path.exists(self.selected_dir):
             try:
-                if sys.platform.startswith('win'):
-                    os.startfile(self.selected_dir)
-                elif sys.platform.startswith('darwin'):
-                    subprocess.call(('open', self.selected_dir))
-                elif sys.platform.startswith('linux'):
-                    subprocess.call(('xdg-open', self.selected_dir))
+                open_with_default_app(self.selected_dir)
             except Exception as e:
                 print(f"打开 {self.selected_dir} 时出错: {e}")
         else:
@@ -502,6 +961,12 @@ class FileBrowserTab(QWidget):
 class CopyTab(QWidget):
     def __init__(self):
         super().__init__()
+        self.scan_indexes = {}
+        # 卡路径 -> 最近一次的速度和进度说明
+        self.card_status = {}
+        self.plan_thread = None
+        # 生成计划后是否先显示计划，由用户确认后再拷贝
+        self.confirm_plan = False
         self.initUI()
 
     def initUI(self):
@@ -555,6 +1020,16 @@ class CopyTab(QWidget):
         checkbox_layout.addWidget(checkbox_label)
         checkbox_layout.addWidget(self.separate_mode)
 
+        # 并行拷贝线程数
+        workers_label = QLabel('并行拷贝线程数：')
+        workers_label.setFont(QFont('Arial', 12))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setFont(QFont('Arial', 12))
+        self.workers_spin.setRange(1, 16)
+        self.workers_spin.setValue(copy_workers)
+        checkbox_layout.addWidget(workers_label)
+        checkbox_layout.addWidget(self.workers_spin)
+
         # 视频目标目录选择
         video_layout = QHBoxLayout()
         video_label = QLabel('视频目标目录:')
@@ -571,6 +1046,35 @@ class CopyTab(QWidget):
         video_layout.addWidget(self.video_input)
         video_layout.addWidget(video_button)
 
+        # 镜像导入：卡上的数据只读取一次，同时再拷贝一份到另一个磁盘，留空时只拷贝一份
+        mirror_layout = QHBoxLayout()
+        mirror_label = QLabel('第二份拷贝（可选） 图片:')
+        mirror_label.setFont(QFont('Arial', 12))
+        self.mirror_image_input = QLineEdit(mirror_image_target_directory)
+        self.mirror_image_input.setFont(QFont('Arial', 12))
+        mirror_image_button = QPushButton('选择目录')
+        mirror_image_button.setFont(QFont('Arial', 12))
+        mirror_image_button.setStyleSheet(
+            "QPushButton { background-color: #05B8CC; color: white; border: none; border-radius: 5px; padding: 5px 10px; }"
+            "QPushButton:hover { background-color: #0497AB; }")
+        mirror_image_button.clicked.connect(self.select_mirror_image_directory)
+        mirror_video_label = QLabel('视频:')
+        mirror_video_label.setFont(QFont('Arial', 12))
+        self.mirror_video_input = QLineEdit(mirror_video_target_directory)
+        self.mirror_video_input.setFont(QFont('Arial', 12))
+        mirror_video_button = QPushButton('选择目录')
+        mirror_video_button.setFont(QFont('Arial', 12))
+        mirror_video_button.setStyleSheet(
+            "QPushButton { background-color: #05B8CC; color: white; border: none; border-radius: 5px; padding: 5px 10px; }"
+            "QPushButton:hover { background-color: #0497AB; }")
+        mirror_video_button.clicked.connect(self.select_mirror_video_directory)
+        mirror_layout.addWidget(mirror_label)
+        mirror_layout.addWidget(self.mirror_image_input)
+        mirror_layout.addWidget(mirror_image_button)
+        mirror_layout.addWidget(mirror_video_label)
+        mirror_layout.addWidget(self.mirror_video_input)
+        mirror_layout.addWidget(mirror_video_button)
+
         # SD 卡目录选择
         sd_layout = QHBoxLayout()
         sd_label = QLabel('SD 卡目录:')
@@ -587,6 +1091,23 @@ class CopyTab(QWidget):
         sd_layout.addWidget(self.sd_input)
         sd_layout.addWidget(sd_button)
 
+        # 多卡列表：同时拷贝多张 SD 卡
+        card_layout = QHBoxLayout()
+        self.card_list = QListWidget()
+        self.card_list.setFont(QFont('Arial', 10))
+        self.card_list.setMaximumHeight(100)
+        card_button_layout = QVBoxLayout()
+        add_card_button = QPushButton('添加到多卡列表')
+        add_card_button.setFont(QFont('Arial', 10))
+        add_card_button.clicked.connect(self.add_card)
+        remove_card_button = QPushButton('移除所选卡')
+        remove_card_button.setFont(QFont('Arial', 10))
+        remove_card_button.clicked.connect(self.remove_card)
+        card_button_layout.addWidget(add_card_button)
+        card_button_layout.addWidget(remove_card_button)
+        card_layout.addWidget(self.card_list)
+        card_layout.addLayout(card_button_layout)
+
         # 活动名称输入
         event_layout = QHBoxLayout()
         event_label = QLabel('活动名称:')
@@ -660,6 +1181,22 @@ class CopyTab(QWidget):
         """)
         start_button.clicked.connect(self.start_copying)
 
+        # 只生成导入计划：显示每个文件的目标路径、重名和跳过情况，确认后再拷贝
+        plan_button = QPushButton('预览导入计划')
+        plan_button.setFont(QFont('Arial', 12))
+        plan_button.setStyleSheet(
+            "QPushButton { background-color: #05B8CC; color: white; border: none; border-radius: 5px; padding: 5px 10px; }"
+            "QPushButton:hover { background-color: #0497AB; }")
+        plan_button.clicked.connect(self.preview_plan)
+
+        # 扫描已有图库按钮：为目标目录中已有的文件建立哈希索引，拷贝时跳过重复文件
+        library_button = QPushButton('扫描已有图库')
+        library_button.setFont(QFont('Arial', 12))
+        library_button.setStyleSheet(
+            "QPushButton { background-color: #05B8CC; color: white; border: none; border-radius: 5px; padding: 5px 10px; }"
+            "QPushButton:hover { background-color: #0497AB; }")
+        library_button.clicked.connect(self.scan_library)
+
         # 使用说明书
         instruction_text = """
 使用说明：
@@ -671,6 +1208,12 @@ class CopyTab(QWidget):
 6. 选择日期：从下拉框中选择要拷贝的文件日期，若选择“全部日期”，将拷贝所有日期的文件。
 7. 开始拷贝：点击“开始拷贝”按钮，程序将开始拷贝文件，并在进度条中显示拷贝进度。
 8. 查看结果：拷贝完成后，结果将显示在下方的文本区域。
+9. 多卡拷贝：选择 SD 卡目录后点击“添加到多卡列表”，可添加多张卡。列表不为空时，“开始拷贝”会同时拷贝列表中的所有卡，
+   并在列表中显示每张卡的进度和速度。
+10. 扫描已有图库：为目标目录中已有的照片和视频建立哈希索引，之后拷贝时会跳过图库中内容相同的文件。
+11. 预览导入计划：只列出每个文件将拷贝到的位置、重名改名和跳过的文件，不拷贝任何数据，确认后再开始拷贝。
+    开始拷贝前会先检查目标磁盘的剩余空间，空间不足时不会拷贝任何文件。
+12. 第二份拷贝：填写后卡上的数据只读取一次，同时写入两个目录，两份各自校验，适合格式化卡之前需要两份备份的情况。
 """
         instruction_label = QTextEdit()
         instruction_label.setReadOnly(True)
@@ -685,12 +1228,16 @@ class CopyTab(QWidget):
         main_layout.addLayout(image_layout)
         main_layout.addLayout(checkbox_layout)
         main_layout.addLayout(video_layout)
+        main_layout.addLayout(mirror_layout)
         main_layout.addLayout(sd_layout)
+        main_layout.addLayout(card_layout)
         main_layout.addLayout(event_layout)
         main_layout.addLayout(date_layout)
         main_layout.addWidget(self.progress_bar)
         main_layout.addWidget(self.result_label)
         main_layout.addWidget(start_button)
+        main_layout.addWidget(plan_button)
+        main_layout.addWidget(library_button)
         main_layout.addWidget(instruction_label)
 
         self.setLayout(main_layout)
@@ -710,6 +1257,16 @@ class CopyTab(QWidget):
         if directory:
             self.video_input.setText(directory)
 
+    def select_mirror_image_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, '选择第二份拷贝的图片目录')
+        if directory:
+            self.mirror_image_input.setText(directory)
+
+    def select_mirror_video_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, '选择第二份拷贝的视频目录')
+        if directory:
+            self.mirror_video_input.setText(directory)
+
     def select_sd_directory(self):
         directory = QFileDialog.getExistingDirectory(self, '选择 SD 卡目录')
         if directory:
@@ -717,36 +1274,24 @@ class CopyTab(QWidget):
 
     def get_dates(self):
         sd_card = self.sd_input.text()
-        image_extensions = (
-            '.jpg', '.jpeg', '.png', '.raw', '.nef', '.cr2', '.CR3',
-            '.arw',  # 索尼 RAW 格式
-            '.dng',  # 通用 RAW 格式
-            '.raf',  # 富士 RAW 格式
-            '.orf',  # 奥林巴斯 RAW 格式
-            '.pef',  # 宾得 RAW 格式
-            '.srw',  # 三星 RAW 格式
-            '.x3f'  # 适马 RAW 格式
-        )
-        video_extensions = ('.mp4', '.avi', '.mov')
-        dates = set()
-        for root, dirs, files in os.walk(sd_card):
-            for file in files:
-                lower_file = file.lower()
-                is_image = any(lower_file.endswith(ext.lower()) for ext in image_extensions)
-                is_video = any(lower_file.endswith(ext.lower()) for ext in video_extensions)
-                if is_image or is_video:
-                    file_path = os.path.join(root, file)
-                    try:
-                        date_taken = datetime.datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y%m%d')
-                        dates.add(date_taken)
-                    except Exception as e:
-                        logging.error(f"Failed to get modification time for {file}: {e}")
+        # 扫描结果保留下来，开始拷贝时不再重新遍历 SD 卡；之后换了卡的话生成计划时由 is_current() 发现并重新扫描
+        scan_index = CardScanIndex(sd_card)
+        self.scan_indexes[sd_card] = scan_index
         self.date_combo.clear()
         self.date_combo.addItem("全部日期")
-        for date in sorted(dates):
+        for date in scan_index.dates():
             self.date_combo.addItem(date)
 
     def start_copying(self):
+        self.start_planning(confirm=False)
+
+    def preview_plan(self):
+        self.start_planning(confirm=True)
+
+    def start_planning(self, confirm):
+        """先在后台生成所有卡的导入计划并检查磁盘空间，计划生成后再开始拷贝"""
+        if self.plan_thread is not None and self.plan_thread.isRunning():
+            return
         image_target = self.image_input.text()
         separate_mode = self.separate_mode.isChecked()
         video_target = self.video_input.text()
@@ -758,10 +1303,82 @@ class CopyTab(QWidget):
         else:
             selected_dates = [selected_date]
 
-        self.copy_thread = CopyThread(image_target, separate_mode, video_target, sd_card, event_name, selected_dates)
-        self.copy_thread.progress_signal.connect(self.update_progress)
-        self.copy_thread.result_signal.connect(self.show_result)
-        self.copy_thread.start()
+        cards = [self.card_list.item(i).data(Qt.UserRole) for i in range(self.card_list.count())] or [sd_card]
+        self.progress_bar.setValue(0)
+        self.result_label.setText("正在生成导入计划…")
+        self.confirm_plan = confirm
+        mirror_targets = (self.mirror_image_input.text().strip() or None,
+                          self.mirror_video_input.text().strip() or None)
+        self.plan_thread = PlanThread(cards, image_target, separate_mode, video_target, event_name, selected_dates,
+                                      scan_indexes=self.scan_indexes, mirror_targets=mirror_targets)
+        self.plan_thread.plans_ready.connect(self.on_plans_ready)
+        self.plan_thread.start()
+
+    def on_plans_ready(self, plans, shortfalls):
+        text = '\n'.join(f'{card}: {plan.describe()}' for card, plan in plans.items())
+        self.result_label.setText(text)
+        if shortfalls:
+            QMessageBox.warning(self, "磁盘空间不足", f"{space_shortfall_message(shortfalls)}\n\n{text}")
+            return
+        if self.confirm_plan:
+            box = QMessageBox(QMessageBox.Question, "导入计划", f"{text}\n\n是否按照这个计划开始拷贝？",
+                              QMessageBox.Yes | QMessageBox.No, self)
+            box.setDetailedText('\n'.join(line for plan in plans.values() for line in plan.lines()))
+            if box.exec_() != QMessageBox.Yes:
+                return
+        thread = self.plan_thread
+        image_target, separate_mode, video_target = thread.job_args
+        # 只拷贝一张卡时也通过调度器执行，由调度器定时读取拷贝速度和进度，不会每个文件都刷新一次界面
+        self.card_status = {}
+        self.copy_scheduler = MultiCardCopyScheduler(thread.cards, image_target, separate_mode, video_target,
+                                                     thread.event_name, thread.selected_dates,
+                                                     workers=self.workers_spin.value(),
+                                                     scan_indexes=self.scan_indexes, plans=plans,
+                                                     reservations=thread.reservations,
+                                                     mirror_targets=thread.mirror_targets)
+        self.copy_scheduler.metrics_signal.connect(self.update_card_metrics)
+        self.copy_scheduler.overall_progress_signal.connect(self.update_overall_progress)
+        self.copy_scheduler.result_signal.connect(self.show_result)
+        self.copy_scheduler.start()
+
+    def scan_library(self):
+        self.progress_bar.setValue(0)
+        self.library_thread = LibraryScanThread([self.image_input.text(), self.video_input.text()])
+        self.library_thread.progress_signal.connect(self.update_progress)
+        self.library_thread.result_signal.connect(self.show_result)
+        self.library_thread.start()
+
+    def add_card(self):
+        card = self.sd_input.text()
+        cards = [self.card_list.item(i).data(Qt.UserRole) for i in range(self.card_list.count())]
+        if card and card not in cards:
+            item = QListWidgetItem(card)
+            item.setData(Qt.UserRole, card)
+            self.card_list.addItem(item)
+
+    def remove_card(self):
+        for item in self.card_list.selectedItems():
+            self.card_list.takeItem(self.card_list.row(item))
+
+    def update_card_metrics(self, card, metrics):
+        text = f'{card}    {metrics.percent}%    {metrics.current_mbps:.1f} MB/s（平均 {metrics.average_mbps:.1f} MB/s）'
+        if metrics.stalled:
+            text += f'    已经 {int(metrics.idle_seconds)} 秒没有数据传输，请检查读卡器'
+        self.card_status[card] = text
+        for i in range(self.card_list.count()):
+            item = self.card_list.item(i)
+            if item.data(Qt.UserRole) == card:
+                item.setText(text)
+
+    def update_overall_progress(self, progress, eta):
+        self.progress_bar.setValue(progress)
+        # 卡列表为空（只拷贝输入框中的一张卡）时，速度和卡顿提示显示在结果标签中
+        status = list(self.card_status.values()) if self.card_list.count() == 0 else []
+        if eta >= 0:
+            minutes, seconds = divmod(int(eta), 60)
+            status.append(f'预计剩余时间：{minutes} 分 {seconds} 秒')
+        if status:
+            self.result_label.setText('\n'.join(status))
 
     def update_progress(self, progress):
         self.progress_bar.setValue(progress)
@@ -782,22 +1399,43 @@ class MainWindow(QWidget):
         self.setWindowTitle('摄影师助手')
         self.setGeometry(300, 300, 1000, 700)
 
-        tab_widget = QTabWidget()
+        self.tab_widget = QTabWidget()
 
         copy_tab = CopyTab()
-        file_browser_tab = FileBrowserTab()
+        # 废片清理页面（及其中的文件系统模型）在第一次切换过去时才创建，只拷贝时不会在后台扫描目录
+        self.file_browser_tab = None
+        self.file_browser_container = QWidget()
+        self.file_browser_layout = QVBoxLayout(self.file_browser_container)
+        self.file_browser_layout.setContentsMargins(0, 0, 0, 0)
 
-        tab_widget.addTab(copy_tab, "SD 卡拷贝")
-        tab_widget.addTab(file_browser_tab, "废片清理")
+        self.tab_widget.addTab(copy_tab, "SD 卡拷贝")
+        self.tab_widget.addTab(self.file_browser_container, "废片清理")
+        self.tab_widget.currentChanged.connect(self.on_tab_changed)
 
         layout = QVBoxLayout()
-        layout = QVBoxLayout()
-        layout.addWidget(tab_widget)
+        layout.addWidget(self.tab_widget)
         self.setLayout(layout)
 
+    def on_tab_changed(self, index):
+        if self.tab_widget.widget(index) is self.file_browser_container and self.file_browser_tab is None:
+            self.file_browser_tab = FileBrowserTab()
+            self.file_browser_layout.addWidget(self.file_browser_tab)
+
 
 if __name__ == '__main__':
+    # python PhotoAssistant.py --benchmark-hash [MB]：测量本机上各个哈希算法的速度
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark-hash':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+        for algorithm, speed in sorted(benchmark_hashers(size_mb).items(), key=lambda item: -item[1]):
+            print(f'{algorithm:10s} {speed:10.1f} MB/s')
+        sys.exit(0)
+
+    startup_mark('导入模块')
     app = QApplication(sys.argv)
     window = MainWindow()
+    startup_mark('创建窗口')
     window.show()
+    if os.environ.get('PHOTOASSISTANT_STARTUP_TIMING') or '--startup-timing' in sys.argv:
+        # 事件循环处理完窗口的首次绘制后再计时
+        QTimer.singleShot(0, report_startup_time)
     sys.exit(app.exec_())
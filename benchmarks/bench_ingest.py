@@ -0,0 +1,199 @@
+"""导入和清理的性能基准：生成模拟的 SD 卡目录，分别测量扫描、分类、读取拍摄日期、拷贝、校验和 RAW/JPG 配对的耗时
+
+    python benchmarks/bench_ingest.py --files 5000 --dir /dev/shm --output result.json
+
+结果以 JSON 输出，可以保存下来和之后的结果对比。生成的文件会留在操作系统的文件缓存中，
+测得的是缓存命中时的速度，主要用于比较代码改动前后的差异，而不是测量读卡器本身的速度。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import photoassistant_core as core  # noqa: E402
+
+
+def tiff_with_datetime(captured):
+    """生成只包含 IFD0 和 EXIF IFD 的小端 TIFF 结构，EXIF IFD 中记录 DateTimeOriginal"""
+    value = captured.strftime('%Y:%m:%d %H:%M:%S').encode('ascii') + b'\x00'
+    ifd0_offset = 8
+    exif_offset = ifd0_offset + 2 + 12 + 4
+    value_offset = exif_offset + 2 + 12 + 4
+    data = b'II' + struct.pack('<HI', 42, ifd0_offset)
+    data += struct.pack('<H', 1) + struct.pack('<HHII', core.TAG_EXIF_IFD, 4, 1, exif_offset) + struct.pack('<I', 0)
+    data += struct.pack('<H', 1) + struct.pack('<HHII', core.TAG_DATETIME_ORIGINAL, 2, len(value), value_offset)
+    data += struct.pack('<I', 0)
+    return data + value
+
+
+def jpeg_header(captured):
+    exif = b'Exif\x00\x00' + tiff_with_datetime(captured)
+    return b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + b'\xff\xda\x00\x02'
+
+
+def mp4_header():
+    return struct.pack('>I', 16) + b'ftypisom' + b'\x00' * 4
+
+
+def write_file(path, header, size, filler):
+    with open(path, 'wb') as f:
+        f.write(header)
+        remaining = max(0, size - len(header))
+        while remaining:
+            n = min(remaining, len(filler))
+            f.write(filler[:n])
+            remaining -= n
+
+
+def jittered(rng, size_kb):
+    """文件大小在平均值的 50%～150% 之间均匀分布"""
+    return int(size_kb * 1024 * rng.uniform(0.5, 1.5))
+
+
+def generate_card(root, args):
+    """按照相机的目录结构生成 DCIM/100CANON、101CANON……，返回生成的文件数和总字节数"""
+    rng = random.Random(args.seed)
+    filler = os.urandom(1024 * 1024)
+    start = time.time() - args.days * 86400
+    files = 0
+    total_bytes = 0
+    folder = None
+    shot = 0
+    while files < args.files:
+        if shot % args.per_folder == 0:
+            folder = os.path.join(root, 'DCIM', f'{100 + shot // args.per_folder}CANON')
+            os.makedirs(folder, exist_ok=True)
+        captured = time.localtime(start + shot * args.days * 86400 / max(1, args.files))
+        captured = datetime.datetime(*captured[:6])
+        stem = f'IMG_{shot % 10000:04d}'
+        if rng.random() < args.video_ratio:
+            outputs = [(stem.replace('IMG', 'MVI') + '.MP4', mp4_header(), jittered(rng, args.video_kb))]
+        else:
+            kind = rng.random()
+            outputs = []
+            # RAW+JPG、只有 RAW（已经删掉了 JPG 的废片）、只有 JPG 三种情况
+            if kind < args.raw_ratio:
+                outputs.append((stem + '.CR2', tiff_with_datetime(captured), jittered(rng, args.raw_kb)))
+            if kind >= args.raw_ratio * args.unmatched_ratio:
+                outputs.append((stem + '.JPG', jpeg_header(captured), jittered(rng, args.jpg_kb)))
+        for name, header, size in outputs[:args.files - files]:
+            path = os.path.join(folder, name)
+            write_file(path, header, size, filler)
+            timestamp = time.mktime(captured.timetuple())
+            os.utime(path, (timestamp, timestamp))
+            files += 1
+            total_bytes += size
+        shot += 1
+    return files, total_bytes
+
+
+def measure(name, results, files, total_bytes, func):
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    result = {'seconds': round(seconds, 4), 'files': files, 'bytes': total_bytes,
+              'files_per_s': round(files / seconds, 1) if seconds else None}
+    if total_bytes:
+        result['mb_per_s'] = round(total_bytes / (1024 * 1024) / seconds, 1) if seconds else None
+    results.setdefault(name, []).append(result)
+    return value
+
+
+def run_once(card, work_dir, args, results):
+    # 扫描和分类：只遍历目录，日期使用修改时间
+    index = measure('scan', results, 0, 0, lambda: core.CardScanIndex(card, date_source=core.DATE_SOURCE_MTIME))
+    entries = index.entries
+    total_bytes = sum(entry.size for entry in entries)
+    scan = results['scan'][-1]
+    scan['files'] = len(entries)
+    scan['files_per_s'] = round(len(entries) / scan['seconds'], 1) if scan['seconds'] else None
+    names = [os.path.basename(entry.path) for entry in entries]
+    measure('classify', results, len(names), 0, lambda: [core.classify_file(name) for name in names])
+
+    core._capture_date_cache.clear()
+    measure('capture_dates', results, len(entries), 0,
+            lambda: [core.capture_date(entry.path, entry.size, entry.mtime) for entry in entries])
+
+    target = os.path.join(work_dir, 'target')
+    for name, verify_mode in (('copy', core.VERIFY_NONE), ('copy_hash', core.VERIFY_HASH)):
+        shutil.rmtree(target, ignore_errors=True)
+        job = core.IngestJob(os.path.join(target, 'img'), True, os.path.join(target, 'vid'), card, 'bench', [],
+                             verify_mode=verify_mode, workers=args.workers, scan_index=index,
+                             dedupe_mode=core.DEDUPE_OFF, hash_algorithm=args.hash_algorithm)
+        measure(name, results, len(entries), total_bytes, job.run)
+
+    copied = [os.path.join(root, name) for root, _, files in os.walk(target) for name in files
+              if not name.startswith('.photoassistant')]
+    copied_bytes = sum(os.path.getsize(path) for path in copied)
+    measure('verify', results, len(copied), copied_bytes,
+            lambda: [core.hash_file(path, core.copy_buffer_size, args.hash_algorithm) for path in copied])
+
+    measure('pairing_card', results, len(entries), 0, lambda: core.PairingScan(card).run())
+    # 分类拷贝后的 JPG/RAW 子文件夹结构
+    measure('pairing_library', results, len(copied), 0, lambda: core.PairingScan(target).run())
+    shutil.rmtree(target, ignore_errors=True)
+
+
+def summarize(runs):
+    """多次运行时取最快的一次，同时保留每次的结果"""
+    best = min(runs, key=lambda result: result['seconds'])
+    return dict(best, runs=[result['seconds'] for result in runs])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PhotoAssistant 导入和清理性能基准')
+    parser.add_argument('--files', type=int, default=2000, help='生成的文件数')
+    parser.add_argument('--raw-ratio', type=float, default=0.8, help='带 RAW 的照片比例')
+    parser.add_argument('--unmatched-ratio', type=float, default=0.3, help='RAW 照片中没有对应 JPG 的比例')
+    parser.add_argument('--video-ratio', type=float, default=0.02, help='视频文件比例')
+    parser.add_argument('--jpg-kb', type=int, default=512, help='JPG 平均大小（KB）')
+    parser.add_argument('--raw-kb', type=int, default=1024, help='RAW 平均大小（KB）')
+    parser.add_argument('--video-kb', type=int, default=16384, help='视频平均大小（KB）')
+    parser.add_argument('--per-folder', type=int, default=999, help='每个 DCIM 子文件夹中的照片数')
+    parser.add_argument('--days', type=int, default=3, help='拍摄日期分布的天数')
+    parser.add_argument('--workers', type=int, default=core.copy_workers, help='拷贝线程数')
+    parser.add_argument('--hash-algorithm', choices=sorted(core.HASH_ALGORITHMS), default=core.copy_hash_algorithm)
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数，结果取最快的一次')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', default=None, help='生成测试数据的目录，例如 /dev/shm；默认使用系统临时目录')
+    parser.add_argument('--output', default=None, help='结果写入的 JSON 文件，默认输出到标准输出')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='photoassistant-bench-', dir=args.dir)
+    try:
+        card = os.path.join(work_dir, 'card')
+        start = time.perf_counter()
+        files, total_bytes = generate_card(card, args)
+        generate_seconds = time.perf_counter() - start
+        results = {}
+        for _ in range(max(1, args.repeat)):
+            run_once(card, work_dir, args, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'params': {key: value for key, value in vars(args).items() if key not in ('dir', 'output')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'work_dir': work_dir},
+        'card': {'files': files, 'bytes': total_bytes, 'generate_seconds': round(generate_seconds, 3)},
+        'results': {name: summarize(runs) for name, runs in results.items()},
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""PhotoAssistant 命令行入口，不需要图形界面，可以在导入工作站或 udev 等自动化脚本中使用
+
+    python photoassistant_cli.py ingest --src H:\\ --event 婚礼 --date 20240501 --json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+
+# 核心模块在导入时读取配置文件，并以其中的值作为下面各个参数的默认值，所以要先处理 --config 再导入，见 load_core()
+core = None
+
+
+def load_core(config_path=None):
+    """按 --config 指定的配置文件导入核心模块；同一进程中只有第一次导入时读取配置文件"""
+    global core
+    if config_path:
+        os.environ['PHOTOASSISTANT_CONFIG'] = os.path.abspath(config_path)
+    import photoassistant_core
+    core = photoassistant_core
+    return core
+
+
+def add_config_argument(parser, default=None):
+    parser.add_argument('--config', default=default,
+                        help='配置文件路径，也可以用环境变量 PHOTOASSISTANT_CONFIG 指定；默认使用当前目录下的 config.ini')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='photoassistant', description='照片和视频导入工具')
+    add_config_argument(parser)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='-v 输出 INFO 日志，-vv 输出逐个文件的调试日志；不指定时使用 config.ini 中的日志级别')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='把 SD 卡中的照片和视频导入到目标目录')
+    # 写在子命令之后也可以，不会覆盖写在子命令之前的值
+    add_config_argument(ingest, argparse.SUPPRESS)
+    ingest.add_argument('--src', action='append', help='SD 卡目录，可以重复指定多张卡；使用 --plan 时不需要')
+    ingest.add_argument('--image-target', default=core.image_target_directory, help='图片目标目录')
+    ingest.add_argument('--video-target', default=core.video_target_directory, help='视频目标目录')
+    ingest.add_argument('--mirror-image-target', default=core.mirror_image_target_directory,
+                        help='镜像导入：同时把图片拷贝一份到这个目录，卡上的数据只读取一次')
+    ingest.add_argument('--mirror-video-target', default=core.mirror_video_target_directory,
+                        help='镜像导入：同时把视频拷贝一份到这个目录')
+    ingest.add_argument('--event', help='活动名称，文件夹命名为 日期_活动名称；使用 --plan 时不需要')
+    ingest.add_argument('--date', action='append', default=[],
+                        help='只导入指定日期（YYYYMMDD）的文件，可以重复指定；不指定时导入全部日期')
+    ingest.add_argument('--separate', action='store_true', help='JPG 和 RAW 分别放到 JPG、RAW 子文件夹中')
+    ingest.add_argument('--workers', type=int, default=core.copy_workers, help='并行拷贝线程数')
+    ingest.add_argument('--verify', choices=core.VERIFY_MODES, default=core.copy_verify_mode,
+                        help='校验模式：readback 回读目标文件比对哈希（默认）；hash 只计算源文件哈希，不检查目标文件；none 不校验')
+    ingest.add_argument('--dedupe', choices=core.DEDUPE_MODES, default=core.copy_dedupe_mode,
+                        help='图库中已有相同文件时的处理方式')
+    ingest.add_argument('--hash-algorithm', choices=sorted(core.HASH_ALGORITHMS), default=core.copy_hash_algorithm,
+                        help='校验使用的哈希算法')
+    ingest.add_argument('--backend', choices=('auto',) + core.COPY_BACKENDS, default=core.copy_backend,
+                        help='拷贝方式，auto 自动选择可用的最快方式')
+    ingest.add_argument('--json', action='store_true', help='以 JSON Lines 格式在标准输出上输出进度，每行一个事件')
+    ingest.add_argument('--progress-interval', type=float, default=1.0, help='输出进度的间隔秒数')
+    ingest.add_argument('--dry-run', action='store_true', help='只生成并输出导入计划，不创建文件夹也不拷贝文件')
+    ingest.add_argument('--plan-output', default=None, help='把导入计划保存为 JSON 文件，便于检查')
+    ingest.add_argument('--plan', default=None,
+                        help='执行 --plan-output 保存的导入计划，不重新扫描和分配路径；卡上的文件与计划不一致时不拷贝')
+
+    benchmark = subparsers.add_parser('benchmark-hash', help='测量本机上各个哈希算法的速度')
+    add_config_argument(benchmark, argparse.SUPPRESS)
+    benchmark.add_argument('size_mb', nargs='?', type=int, default=256, help='测试数据大小（MB）')
+    return parser
+
+
+class ProgressPrinter:
+    """把导入任务的进度输出到终端，或者以 JSON Lines 格式输出到标准输出"""
+
+    def __init__(self, as_json):
+        self.as_json = as_json
+
+    def event(self, event, **fields):
+        if self.as_json:
+            print(json.dumps(dict(event=event, **fields), ensure_ascii=False), flush=True)
+
+    def progress(self, src, job, metrics):
+        if self.as_json:
+            self.event('progress', src=src, percent=metrics.percent, files_done=job.done_files,
+                       files_total=job.total_files, bytes_done=metrics.done_bytes, bytes_total=metrics.total_bytes,
+                       mb_per_s=round(metrics.current_mbps, 2), average_mb_per_s=round(metrics.average_mbps, 2),
+                       eta=round(metrics.eta, 1), stalled=metrics.stalled, failed=job.failed_files)
+        elif sys.stderr.isatty():
+            text = f'\r{src}: {metrics.percent}%  {metrics.current_mbps:.1f} MB/s'
+            if metrics.eta >= 0:
+                text += f'  剩余 {int(metrics.eta)} 秒'
+            if metrics.stalled:
+                text += f'  已经 {int(metrics.idle_seconds)} 秒没有数据传输'
+            print(text.ljust(79), end='', file=sys.stderr, flush=True)
+
+    def watch(self, src, job, interval):
+        """在后台线程中定时输出进度，返回 (Event, 线程)：设置 Event 后等待线程结束，最后一行进度不会出现在结果之后"""
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                if job.metrics.start_time is not None:
+                    self.progress(src, job, job.metrics.snapshot())
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return stopped, thread
+
+    def plan(self, plan, verbose):
+        if self.as_json:
+            self.event('plan', **plan.summary())
+        else:
+            print(f'{plan.sd_card}: {plan.describe()}')
+            if verbose:
+                for line in plan.lines():
+                    print(f'  {line}')
+
+    def done(self, src, job, result):
+        if self.as_json:
+            self.event('done', result=result, **job.summary())
+        else:
+            if sys.stderr.isatty():
+                print(file=sys.stderr)
+            print(f'{src}: {result}')
+
+
+def plan_jobs(args, printer, reservations):
+    """扫描每张卡并生成导入计划，先为所有卡生成计划，检查目标磁盘空间之后再开始拷贝"""
+    jobs = []
+    for src in args.src:
+        scan_index = core.CardScanIndex(src)
+        printer.event('scan', src=src, files=len(scan_index.entries),
+                      bytes=sum(entry.size for entry in scan_index.entries), dates=scan_index.dates())
+        job = core.IngestJob(args.image_target, args.separate, args.video_target, src, args.event, args.date,
+                             verify_mode=args.verify, workers=args.workers, reservations=reservations,
+                             scan_index=scan_index, dedupe_mode=args.dedupe, hash_algorithm=args.hash_algorithm,
+                             backend=args.backend, mirror_image_target=args.mirror_image_target,
+                             mirror_video_target=args.mirror_video_target)
+        job.plan = job.make_plan()
+        printer.plan(job.plan, args.dry_run and not args.json)
+        jobs.append((src, job))
+    return jobs
+
+
+def load_jobs(args, printer, reservations):
+    """读取保存的导入计划并还原拷贝任务；卡上的文件与计划不一致时返回 None"""
+    with open(args.plan, encoding='utf-8') as f:
+        plans = [core.IngestPlan.from_dict(data) for data in json.load(f)]
+    jobs = []
+    for plan in plans:
+        stale = plan.stale_items()
+        if stale:
+            message = (f'{plan.sd_card}: 生成计划之后卡上有 {len(stale)} 个文件发生了变化'
+                       f'（例如 {stale[0].path}），请重新生成计划')
+            printer.event('error', message=message, src=plan.sd_card, stale=[item.path for item in stale])
+            if not args.json:
+                print(message, file=sys.stderr)
+            return None
+        settings = plan.settings
+        # 计划中已经分配的目标路径不能再分配给改名的文件
+        reservations.hold([item.destination for item in plan.items if item.action in (core.PLAN_COPY, core.PLAN_LINK)]
+                          + [item.mirror for item in plan.items if item.mirror])
+        job = core.IngestJob(settings.get('image_target', args.image_target), settings.get('separate', args.separate),
+                             settings.get('video_target', args.video_target), plan.sd_card,
+                             settings.get('event', args.event), [], verify_mode=args.verify, workers=args.workers,
+                             reservations=reservations, dedupe_mode=args.dedupe,
+                             hash_algorithm=settings.get('hash_algorithm', args.hash_algorithm), backend=args.backend,
+                             plan=plan,
+                             mirror_image_target=settings.get('mirror_image_target', args.mirror_image_target),
+                             mirror_video_target=settings.get('mirror_video_target', args.mirror_video_target))
+        job.skip_copied()
+        printer.plan(plan, args.dry_run and not args.json)
+        jobs.append((plan.sd_card, job))
+    return jobs
+
+
+def run_ingest(args):
+    printer = ProgressPrinter(args.json)
+    # 多张卡共用一份目标路径分配表，避免不同机身的同名文件互相覆盖
+    reservations = core.PathReservations()
+    if args.plan:
+        jobs = load_jobs(args, printer, reservations)
+        if jobs is None:
+            return 1
+    else:
+        jobs = plan_jobs(args, printer, reservations)
+    plans = [job.plan for _, job in jobs]
+    if args.plan_output:
+        with open(args.plan_output, 'w', encoding='utf-8') as f:
+            json.dump([plan.to_dict() for plan in plans], f, ensure_ascii=False, indent=1)
+
+    shortfalls = core.check_free_space(plans)
+    if shortfalls:
+        message = core.space_shortfall_message(shortfalls)
+        printer.event('error', message=message, shortfalls=[shortfall._asdict() for shortfall in shortfalls])
+        if not args.json:
+            print(message, file=sys.stderr)
+        return 1
+    if args.dry_run:
+        return 0
+
+    failed = 0
+    for src, job in jobs:
+        # 按固定间隔输出进度，文件很多时也不会刷屏
+        stop_watching, watcher = printer.watch(src, job, args.progress_interval)
+        result = job.run()
+        stop_watching.set()
+        watcher.join()
+        printer.done(src, job, result)
+        failed += job.failed_files + job.mirror_failed_files + (1 if job.error else 0)
+    return 1 if failed else 0
+
+
+def run_benchmark(args):
+    for algorithm, speed in sorted(core.benchmark_hashers(args.size_mb).items(), key=lambda item: -item[1]):
+        print(f'{algorithm:10s} {speed:10.1f} MB/s')
+    return 0
+
+
+def main(argv=None):
+    # 先只解析 --config，按它导入核心模块之后才能生成带默认值的完整参数
+    config_parser = argparse.ArgumentParser(prog='photoassistant', add_help=False)
+    add_config_argument(config_parser)
+    config_path = config_parser.parse_known_args(argv)[0].config
+    if config_path and not os.path.isfile(config_path):
+        config_parser.error(f'配置文件不存在: {config_path}')
+    load_core(config_path)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'ingest' and not args.plan and not (args.src and args.event):
+        parser.error('ingest 需要 --src 和 --event，或者用 --plan 指定保存的导入计划')
+    level = {0: None, 1: logging.INFO}.get(args.verbose, logging.DEBUG)
+    # 日志输出到标准错误，标准输出只留给进度和结果
+    core.configure_logging(level, stream=sys.stderr)
+    if args.command == 'ingest':
+        return run_ingest(args)
+    return run_benchmark(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2783 @@
+"""PhotoAssistant 的核心功能：拷贝、校验、查重、日期读取和 RAW 清理，不依赖 Qt
+
+图形界面（PhotoAssistant.py）和命令行（photoassistant_cli.py）都调用这里的代码
+"""
+import os
+import datetime
+import shutil
+import struct
+import sys
+import hashlib
+import importlib
+import importlib.util
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+
+import configparser
+import errno
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# 读取配置文件：环境变量 PHOTOASSISTANT_CONFIG 指定的文件，没有指定时使用当前目录下的 config.ini
+CONFIG_PATH = os.environ.get('PHOTOASSISTANT_CONFIG') or 'config.ini'
+config = configparser.ConfigParser()
+if not config.read(CONFIG_PATH) and os.environ.get('PHOTOASSISTANT_CONFIG'):
+    logging.warning("Config file %s could not be read, using defaults", CONFIG_PATH)
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def configure_logging(level=None, stream=None):
+    """配置日志输出；没有指定级别时依次使用环境变量 PHOTOASSISTANT_LOG_LEVEL、config.ini 的 [Logging] level，默认 INFO
+
+    逐个文件的拷贝记录使用 DEBUG 级别，文件很多时输出大量日志会明显拖慢拷贝，只在需要排查问题时打开
+    """
+    if level is None:
+        level = os.environ.get('PHOTOASSISTANT_LOG_LEVEL') or config.get('Logging', 'level', fallback='INFO')
+    if isinstance(level, str):
+        name = level.strip().upper()
+        level = logging.getLevelName(name)
+        if not isinstance(level, int):
+            logging.warning("Unknown log level '%s', falling back to INFO", name)
+            level = logging.INFO
+    # 导入本模块时读取配置项出错会先输出警告，logging 会因此自动添加默认的处理器，这里需要替换掉
+    logging.basicConfig(level=level, format=LOG_FORMAT, stream=stream, force=True)
+
+
+# 获取用户图片和视频文件夹路径
+def get_user_pictures_folder():
+    if os.name == 'nt':  # Windows 系统
+        return os.path.join(os.environ['USERPROFILE'], 'Pictures')
+    elif os.name == 'posix':  # macOS 或 Linux 系统
+        return os.path.join(str(Path.home()), 'Pictures')
+    return None
+
+
+def get_user_videos_folder():
+    if os.name == 'nt':  # Windows 系统
+        return os.path.join(os.environ['USERPROFILE'], 'Videos')
+    elif os.name == 'posix':  # macOS 或 Linux 系统
+        return os.path.join(str(Path.home()), 'Movies')
+    return None
+
+
+# 获取用户桌面路径
+def get_user_desktop_folder():
+    if os.name == 'nt':  # Windows 系统
+        return os.path.join(os.environ['USERPROFILE'], 'Desktop')
+    elif os.name == 'posix':  # macOS 或 Linux 系统
+        return os.path.join(str(Path.home()), 'Desktop')
+    return None
+
+
+# 缓存文件夹，例如清理页面的预览图
+def get_user_cache_folder():
+    if os.name == 'nt':  # Windows 系统
+        return os.path.join(os.environ.get('LOCALAPPDATA') or os.environ['USERPROFILE'], 'PhotoAssistant', 'Cache')
+    elif os.name == 'posix':  # macOS 或 Linux 系统
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(str(Path.home()), '.cache'),
+                            'PhotoAssistant')
+    return None
+
+
+# 获取默认路径
+image_target_directory = config.get('Paths', 'image_target_directory', fallback=get_user_desktop_folder())
+video_target_directory = config.get('Paths', 'video_target_directory', fallback=get_user_desktop_folder())
+sd_card_directory = config.get('Paths', 'sd_card_directory', fallback='H:\\')
+# 镜像导入的第二份拷贝目录，留空时只拷贝一份
+mirror_image_target_directory = config.get('Paths', 'mirror_image_target_directory', fallback='')
+mirror_video_target_directory = config.get('Paths', 'mirror_video_target_directory', fallback='')
+
+# 拷贝校验模式：不校验 / 边写边计算源文件哈希 / 拷贝完成后回读目标文件比对哈希
+VERIFY_NONE = 'none'
+VERIFY_HASH = 'hash'
+VERIFY_READBACK = 'readback'
+VERIFY_MODES = (VERIFY_NONE, VERIFY_HASH, VERIFY_READBACK)
+
+# 重复文件处理：照常拷贝 / 图库中已有相同内容时跳过 / 用硬链接代替拷贝
+DEDUPE_OFF = 'off'
+DEDUPE_SKIP = 'skip'
+DEDUPE_HARDLINK = 'hardlink'
+DEDUPE_MODES = (DEDUPE_OFF, DEDUPE_SKIP, DEDUPE_HARDLINK)
+
+# 文件日期来源：照片 EXIF / 视频文件中记录的拍摄时间（读取不到时使用修改时间），或者只使用修改时间
+DATE_SOURCE_EXIF = 'exif'
+DATE_SOURCE_MTIME = 'mtime'
+
+# 获取拷贝参数
+copy_buffer_size = config.getint('Copy', 'buffer_size', fallback=1024 * 1024)
+# 默认回读校验：源文件的哈希在拷贝时顺便计算，卡上的数据仍然只读取一次，只多读一遍目标文件；
+# hash 模式不读取目标文件，发现不了写入目标磁盘时出的错
+copy_verify_mode = config.get('Copy', 'verify_mode', fallback=VERIFY_READBACK).strip().lower()
+if copy_verify_mode not in VERIFY_MODES:
+    logging.warning("Unknown verify_mode '%s' in config.ini, falling back to '%s'", copy_verify_mode, VERIFY_READBACK)
+    copy_verify_mode = VERIFY_READBACK
+# 并行拷贝线程数，1 表示逐个文件顺序拷贝；可按读卡器和目标磁盘的性能调整
+copy_workers = config.getint('Copy', 'workers', fallback=1)
+copy_dedupe_mode = config.get('Copy', 'dedupe', fallback=DEDUPE_SKIP).strip().lower()
+if copy_dedupe_mode not in DEDUPE_MODES:
+    logging.warning("Unknown dedupe mode '%s' in config.ini, falling back to '%s'", copy_dedupe_mode, DEDUPE_SKIP)
+    copy_dedupe_mode = DEDUPE_SKIP
+copy_date_source = config.get('Copy', 'date_source', fallback=DATE_SOURCE_EXIF).strip().lower()
+# 拷贝方式：auto 自动选择，或者指定 reflink / copy_file_range / sendfile / userspace，不可用时退回用户态拷贝
+copy_backend = config.get('Copy', 'backend', fallback='auto').strip().lower()
+# 超过这么多秒没有任何数据传输时认为拷贝卡住了（例如读卡器接触不良）
+copy_stall_seconds = config.getfloat('Copy', 'stall_seconds', fallback=15.0)
+# 镜像导入时每个目标磁盘的写入缓冲（MB），慢的磁盘最多落后这么多数据，不会拖慢另一个磁盘
+copy_mirror_buffer_mb = config.getint('Copy', 'mirror_buffer_mb', fallback=256)
+# 开始拷贝前要求目标磁盘在需要写入的数据之外至少还剩下这么多空间（MB）
+copy_free_space_margin_mb = config.getint('Copy', 'free_space_margin_mb', fallback=256)
+# 清理文件时每次交给回收站的文件数，以及跨磁盘移动时用来估算耗时的速度（MB/s）
+cleanup_trash_batch_size = config.getint('Cleanup', 'trash_batch_size', fallback=200)
+cleanup_cross_device_mbps = config.getfloat('Cleanup', 'cross_device_mbps', fallback=80.0)
+# 清理页面预览图：最长边像素数、内存中缓存的张数、磁盘缓存文件夹和大小上限（MB）
+preview_max_size = config.getint('Preview', 'max_size', fallback=1280)
+preview_memory_items = config.getint('Preview', 'memory_items', fallback=40)
+preview_cache_directory = config.get('Preview', 'cache_dir', fallback='') or \
+    os.path.join(get_user_cache_folder() or '.', 'previews')
+preview_cache_mb = config.getint('Preview', 'cache_mb', fallback=500)
+
+
+class Crc32Hasher:
+    """hashlib 接口的 CRC-32，作为不需要安装第三方库的快速非加密校验算法"""
+    name = 'crc32'
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+# 可选的哈希算法：sha256 为默认值；blake2b 同样是加密哈希，在没有 SHA 硬件加速的 CPU 上通常更快；
+# crc32/xxh3 为非加密的快速校验。具体选择可以参考 --benchmark-hash 的测量结果
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'crc32': Crc32Hasher,
+}
+
+
+def _optional_hasher(module_name, attribute):
+    """可选依赖提供的哈希算法，启动时只检查模块是否已安装，第一次使用时才导入"""
+    def create():
+        return getattr(importlib.import_module(module_name), attribute)()
+    return create
+
+
+if importlib.util.find_spec('xxhash') is not None:
+    HASH_ALGORITHMS['xxh3_64'] = _optional_hasher('xxhash', 'xxh3_64')
+    HASH_ALGORITHMS['xxh3_128'] = _optional_hasher('xxhash', 'xxh3_128')
+if importlib.util.find_spec('blake3') is not None:
+    HASH_ALGORITHMS['blake3'] = _optional_hasher('blake3', 'blake3')
+
+copy_hash_algorithm = config.get('Copy', 'hash_algorithm', fallback='sha256').strip().lower()
+if copy_hash_algorithm not in HASH_ALGORITHMS:
+    logging.warning("Hash algorithm '%s' is not available, falling back to 'sha256'", copy_hash_algorithm)
+    copy_hash_algorithm = 'sha256'
+
+
+def new_hasher(algorithm=copy_hash_algorithm):
+    return HASH_ALGORITHMS[algorithm]()
+
+
+_local_buffers = threading.local()
+
+
+def local_buffer(buffer_size):
+    """当前线程复用的读写缓冲区，逐个处理大量小文件时不必为每个文件重新分配"""
+    buffer = getattr(_local_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = _local_buffers.buffer = bytearray(buffer_size)
+    return buffer
+
+
+class InlineHasher:
+    """与 BackgroundHasher 接口相同，在当前线程中计算哈希
+
+    用于一个缓冲区就能装下的小文件：只有一块数据时后台线程无法与读写重叠，启动线程的开销反而比计算哈希更大。
+    """
+
+    def __init__(self, algorithm, buffer_size):
+        self.hasher = new_hasher(algorithm)
+        self.buffer = local_buffer(buffer_size)
+
+    def get_buffer(self):
+        return self.buffer
+
+    def submit(self, buffer, n):
+        self.hasher.update(memoryview(buffer)[:n])
+
+    def finish(self):
+        return self.hasher.hexdigest()
+
+
+class BackgroundHasher:
+    """在独立线程中计算哈希，与文件读写重叠进行
+
+    缓冲区在读写线程和哈希线程之间轮流使用，最多分配 buffers 个，内存占用不随文件大小增长。
+    """
+
+    def __init__(self, algorithm, buffer_size, buffers=4):
+        self.hasher = new_hasher(algorithm)
+        self.buffer_size = buffer_size
+        self.max_buffers = buffers
+        self.allocated = 0
+        self.free = queue.Queue()
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            buffer, n = item
+            self.hasher.update(memoryview(buffer)[:n])
+            self.free.put(buffer)
+
+    def get_buffer(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            if self.allocated < self.max_buffers:
+                self.allocated += 1
+                return bytearray(self.buffer_size)
+            return self.free.get()
+
+    def submit(self, buffer, n):
+        self.pending.put((buffer, n))
+
+    def finish(self):
+        """等待所有数据计算完毕并返回十六进制哈希值"""
+        self.pending.put(None)
+        self.thread.join()
+        return self.hasher.hexdigest()
+
+
+PARTIAL_SUFFIX = '.partial'
+
+
+class HashMismatchError(Exception):
+    pass
+
+
+def partial_path(path):
+    """拷贝过程中使用的临时文件：同一文件夹中的 .<文件名>.partial
+
+    拷贝被强行中断时只会留下临时文件，正式文件名下不会出现不完整的文件；再次导入时分配到同一个文件名，
+    直接覆盖留下的临时文件
+    """
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f'.{name}{PARTIAL_SUFFIX}')
+
+
+def place_file(partial, dst, overwrite=False):
+    """把校验通过的临时文件改成正式文件名
+
+    overwrite 为 False 时用一步完成、不会覆盖的方式改名：目标文件夹快照过期、其它程序已经写入了同名文件时
+    抛出 FileExistsError，临时文件保留，由调用方换一个文件名后再次调用。中途断电或网络断开时正式文件名下
+    要么没有文件，要么是完整的文件，不会留下空文件。
+    """
+    if overwrite:
+        os.replace(partial, dst)
+    elif os.name == 'nt':
+        # Windows 上 rename 在目标已存在时失败
+        os.rename(partial, dst)
+    else:
+        try:
+            os.link(partial, dst)
+        except OSError as e:
+            # 目标已存在时是 FileExistsError（EEXIST），直接抛出；
+            # FAT/exFAT 等不支持硬链接的文件系统：先检查再改名，只在这很短的间隔内可能覆盖其它程序刚写入的文件
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            if os.path.lexists(dst):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+            os.rename(partial, dst)
+            return
+        os.remove(partial)
+
+
+def discard_file(path):
+    """删除拷贝失败或校验不一致的目标文件，避免以正常的文件名留在图库中"""
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logging.warning('删除文件时出错: %s, 错误信息: %s', path, e)
+
+
+def hash_file(file_path, buffer_size=copy_buffer_size, algorithm=copy_hash_algorithm, progress_callback=None):
+    """分块计算文件的哈希，内存占用不超过一个缓冲区；progress_callback(字节数) 在每读取一块数据后调用"""
+    hasher = new_hasher(algorithm)
+    buffer = local_buffer(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+            if progress_callback is not None:
+                progress_callback(n)
+    return hasher.hexdigest()
+
+
+def copy_file_with_hash(src, dst, buffer_size=copy_buffer_size, verify_mode=VERIFY_READBACK,
+                        algorithm=copy_hash_algorithm, progress_callback=None, place=True, verify_callback=None):
+    """分块拷贝文件，源文件只读取一次，写入目标文件的同时在后台线程中计算源文件哈希；
+    一个缓冲区就能装下的小文件直接在当前线程中计算。
+
+    数据先写入临时文件 partial_path(dst)，复制时间戳并校验通过后才改成正式文件名；place 为 False 时保留临时文件，
+    由调用方校验后自行改名。
+    返回源文件的哈希（verify_mode 为 none 时返回 None）。回读校验不一致时删除临时文件并抛出 HashMismatchError。
+    progress_callback(字节数) 在每写入一块数据后调用，verify_callback(字节数) 在回读校验每读取一块数据后调用。
+    """
+    partial = partial_path(dst)
+    hasher = None
+    buffer = local_buffer(buffer_size)
+    try:
+        with open(src, 'rb', buffering=0) as fsrc, open(partial, 'wb') as fdst:
+            if verify_mode != VERIFY_NONE:
+                if os.fstat(fsrc.fileno()).st_size <= buffer_size:
+                    hasher = InlineHasher(algorithm, buffer_size)
+                else:
+                    hasher = BackgroundHasher(algorithm, buffer_size)
+            while True:
+                if hasher is not None:
+                    buffer = hasher.get_buffer()
+                n = fsrc.readinto(buffer)
+                if not n:
+                    break
+                fdst.write(memoryview(buffer)[:n])
+                if hasher is not None:
+                    hasher.submit(buffer, n)
+                if progress_callback is not None:
+                    progress_callback(n)
+        shutil.copystat(src, partial)
+    except BaseException:
+        if hasher is not None:
+            hasher.finish()
+        # 不保留拷贝了一半的临时文件
+        discard_file(partial)
+        raise
+
+    digest = hasher.finish() if hasher is not None else None
+    if verify_mode == VERIFY_READBACK and hash_file(partial, buffer_size, algorithm, verify_callback) != digest:
+        discard_file(partial)
+        raise HashMismatchError(dst)
+    if place:
+        _place_or_discard(partial, dst)
+    return digest
+
+
+def _place_or_discard(partial, dst):
+    try:
+        place_file(partial, dst)
+    except BaseException:
+        discard_file(partial)
+        raise
+
+
+# 拷贝方式，按优先级排列：
+# reflink         写时复制文件系统（btrfs、XFS 等）同一分区内只共享数据块，不需要拷贝数据
+# copy_file_range 由内核在两个文件之间拷贝，不经过用户态缓冲区，部分文件系统和 NAS 可以在服务器端完成
+# sendfile        内核中拷贝的另一个接口，适用于不支持 copy_file_range 的旧内核
+# userspace       分块读写，边写边计算哈希
+BACKEND_REFLINK = 'reflink'
+BACKEND_COPY_FILE_RANGE = 'copy_file_range'
+BACKEND_SENDFILE = 'sendfile'
+BACKEND_USERSPACE = 'userspace'
+COPY_BACKENDS = (BACKEND_REFLINK, BACKEND_COPY_FILE_RANGE, BACKEND_SENDFILE, BACKEND_USERSPACE)
+if copy_backend != 'auto' and copy_backend not in COPY_BACKENDS:
+    logging.warning("Unknown copy backend '%s' in config.ini, falling back to 'auto'", copy_backend)
+    copy_backend = 'auto'
+
+# linux/fs.h 中的 FICLONE ioctl
+FICLONE = 0x40049409
+# 这些错误说明当前的源/目标组合不支持某种拷贝方式，换下一种方式即可
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                      errno.EPERM}
+KERNEL_COPY_CHUNK = 8 * 1024 * 1024
+
+# (源设备, 目标设备) -> 已经确认不支持的拷贝方式
+_unsupported_backends = {}
+_unsupported_backends_lock = threading.Lock()
+
+
+def available_backends():
+    """当前系统上可以尝试的拷贝方式"""
+    backends = []
+    if sys.platform.startswith('linux'):
+        backends.append(BACKEND_REFLINK)
+    if hasattr(os, 'copy_file_range'):
+        backends.append(BACKEND_COPY_FILE_RANGE)
+    # macOS 的 sendfile 只能写入 socket
+    if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+        backends.append(BACKEND_SENDFILE)
+    return backends
+
+
+def _reflink(fsrc, fdst, size, progress_callback):
+    import fcntl
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    if progress_callback is not None:
+        progress_callback(size)
+
+
+def _kernel_copy(copy_chunk, fsrc, fdst, size, progress_callback):
+    offset = 0
+    while offset < size:
+        n = copy_chunk(fsrc.fileno(), fdst.fileno(), offset, min(KERNEL_COPY_CHUNK, size - offset))
+        if n == 0:
+            break
+        offset += n
+        if progress_callback is not None:
+            progress_callback(n)
+    if offset != size:
+        raise OSError(errno.EIO, f'源文件在拷贝过程中发生了变化，只拷贝了 {offset}/{size} 字节')
+
+
+def _copy_file_range(fsrc, fdst, size, progress_callback):
+    _kernel_copy(lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset),
+                 fsrc, fdst, size, progress_callback)
+
+
+def _sendfile(fsrc, fdst, size, progress_callback):
+    _kernel_copy(lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count),
+                 fsrc, fdst, size, progress_callback)
+
+
+_BACKEND_FUNCTIONS = {
+    BACKEND_REFLINK: _reflink,
+    BACKEND_COPY_FILE_RANGE: _copy_file_range,
+    BACKEND_SENDFILE: _sendfile,
+}
+
+
+def _folder_device(folder):
+    return os.stat(folder).st_dev
+
+
+def candidate_backends(src, dst, verify_mode=VERIFY_READBACK, backend=None, device_of=_folder_device):
+    """按优先级返回这一对源/目标可以尝试的内核拷贝方式
+
+    device_of(文件夹) 返回文件夹所在的设备号，批量拷贝时传入按文件夹缓存的版本，不必每个文件都访问一次目标磁盘。
+
+    需要校验时只使用 reflink：reflink 不读写数据，拷贝后再读一遍源文件计算哈希仍然比拷贝快得多；
+    copy_file_range 和 sendfile 需要额外再读一遍源文件才能得到哈希，从 SD 卡导入时反而比边写边计算哈希慢。
+    """
+    backend = backend or copy_backend
+    if backend == BACKEND_USERSPACE:
+        return [], None
+    backends = available_backends()
+    if backend != 'auto':
+        backends = [b for b in backends if b == backend]
+    if verify_mode != VERIFY_NONE:
+        backends = [b for b in backends if b == BACKEND_REFLINK]
+    if not backends:
+        return [], None
+    try:
+        key = (device_of(os.path.dirname(src) or '.'), device_of(os.path.dirname(dst) or '.'))
+    except OSError:
+        return [], None
+    # reflink 只能在同一个文件系统内进行
+    if key[0] != key[1]:
+        backends = [b for b in backends if b != BACKEND_REFLINK]
+    with _unsupported_backends_lock:
+        unsupported = _unsupported_backends.get(key, set())
+        return [b for b in backends if b not in unsupported], key
+
+
+def _mark_unsupported(key, backend, error):
+    with _unsupported_backends_lock:
+        if backend not in _unsupported_backends.setdefault(key, set()):
+            _unsupported_backends[key].add(backend)
+            logging.info("Copy backend %s is not supported between devices %s: %s", backend, key, error)
+
+
+def copy_file_with_backend(src, dst, buffer_size=copy_buffer_size, verify_mode=VERIFY_READBACK,
+                           algorithm=copy_hash_algorithm, progress_callback=None, backend=None, place=True,
+                           device_of=_folder_device, verify_callback=None):
+    """按 reflink → copy_file_range → sendfile → 用户态分块拷贝的顺序选择可用的方式拷贝文件
+
+    每对源/目标设备第一次拷贝时探测各个方式是否可用，不支持的方式记录下来之后不再尝试。
+    返回 (源文件哈希, 使用的拷贝方式)，临时文件和校验规则与 copy_file_with_hash 相同；
+    内核拷贝完成后重新读取源文件计算哈希时也调用 verify_callback。
+    """
+    partial = partial_path(dst)
+    backends, key = candidate_backends(src, dst, verify_mode, backend, device_of)
+    for name in backends:
+        written = [0]
+
+        def on_progress(n):
+            written[0] += n
+            if progress_callback is not None:
+                progress_callback(n)
+
+        try:
+            with open(src, 'rb', buffering=0) as fsrc, open(partial, 'wb', buffering=0) as fdst:
+                _BACKEND_FUNCTIONS[name](fsrc, fdst, os.fstat(fsrc.fileno()).st_size, on_progress)
+            shutil.copystat(src, partial)
+        except OSError as e:
+            discard_file(partial)
+            # 还没有写入任何数据就失败说明不支持这种方式，换下一种；拷贝到一半出错是真正的读写错误
+            if e.errno in UNSUPPORTED_ERRNOS and not written[0]:
+                _mark_unsupported(key, name, e)
+                continue
+            raise
+        except BaseException:
+            discard_file(partial)
+            raise
+        digest = None
+        if verify_mode != VERIFY_NONE:
+            try:
+                digest = hash_file(src, buffer_size, algorithm, verify_callback)
+                if (verify_mode == VERIFY_READBACK
+                        and hash_file(partial, buffer_size, algorithm, verify_callback) != digest):
+                    raise HashMismatchError(dst)
+            except BaseException:
+                discard_file(partial)
+                raise
+        if place:
+            _place_or_discard(partial, dst)
+        return digest, name
+    return (copy_file_with_hash(src, dst, buffer_size, verify_mode, algorithm, progress_callback, place,
+                                verify_callback),
+            BACKEND_USERSPACE)
+
+
+def benchmark_hashers(size_mb=256, buffer_size=copy_buffer_size):
+    """测量本机上各个哈希算法的速度，返回 {算法: MB/s}"""
+    data = os.urandom(buffer_size)
+    rounds = max(1, size_mb * 1024 * 1024 // buffer_size)
+    results = {}
+    for algorithm in HASH_ALGORITHMS:
+        hasher = new_hasher(algorithm)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            hasher.update(data)
+        hasher.hexdigest()
+        elapsed = time.perf_counter() - start
+        results[algorithm] = rounds * buffer_size / (1024 * 1024) / elapsed
+    return results
+
+
+# 媒体类型表：小写扩展名 -> (类别, 厂商)，类别为 'jpg'、'raw'、'video' 或 'sidecar'
+MediaType = namedtuple('MediaType', 'category vendor')
+MEDIA_TYPES = {
+    '.jpg': MediaType('jpg', None),
+    '.jpeg': MediaType('jpg', None),
+    '.png': MediaType('jpg', None),
+    '.raw': MediaType('raw', 'panasonic'),
+    '.nef': MediaType('raw', 'nikon'),
+    '.cr2': MediaType('raw', 'canon'),
+    '.cr3': MediaType('raw', 'canon'),
+    '.arw': MediaType('raw', 'sony'),  # 索尼 RAW 格式
+    '.dng': MediaType('raw', 'adobe'),  # 通用 RAW 格式
+    '.raf': MediaType('raw', 'fujifilm'),  # 富士 RAW 格式
+    '.orf': MediaType('raw', 'olympus'),  # 奥林巴斯 RAW 格式
+    '.pef': MediaType('raw', 'pentax'),  # 宾得 RAW 格式
+    '.srw': MediaType('raw', 'samsung'),  # 三星 RAW 格式
+    '.x3f': MediaType('raw', 'sigma'),  # 适马 RAW 格式
+    '.mp4': MediaType('video', None),
+    '.avi': MediaType('video', None),
+    '.mov': MediaType('video', None),
+    '.xmp': MediaType('sidecar', None),
+    '.thm': MediaType('sidecar', None),
+}
+
+
+# 只在 RAW 清理配对时当作预览图的格式，导入时不拷贝
+PREVIEW_ONLY_EXTENSIONS = {'.heif', '.heic'}
+
+
+def load_media_types(config):
+    """从 config.ini 的 [MediaTypes] 段扩展媒体类型表
+
+    每一项为 类别 = 逗号分隔的扩展名，RAW 格式可以用 扩展名:厂商 指定厂商，例如 raw = .rw2:panasonic, .3fr:hasselblad
+    """
+    if not config.has_section('MediaTypes'):
+        return
+    for category, value in config.items('MediaTypes'):
+        if category not in ('jpg', 'raw', 'video', 'sidecar'):
+            logging.warning("Unknown media category '%s' in config.ini", category)
+            continue
+        for item in value.split(','):
+            ext, _, vendor = item.strip().lower().partition(':')
+            if not ext:
+                continue
+            if not ext.startswith('.'):
+                ext = '.' + ext
+            MEDIA_TYPES[ext] = MediaType(category, vendor or None)
+
+
+load_media_types(config)
+
+
+def media_type_of(file_name):
+    """查找文件的媒体类型，不在媒体类型表中时返回 None"""
+    return MEDIA_TYPES.get(os.path.splitext(file_name)[1].lower())
+
+
+def classify_file(file_name):
+    """返回需要拷贝的文件类别：'jpg'、'raw'、'video'，其它文件返回 None"""
+    media_type = MEDIA_TYPES.get(os.path.splitext(file_name)[1].lower())
+    if media_type is None or media_type.category == 'sidecar':
+        return None
+    return media_type.category
+
+
+# 拍摄日期解析：只读取文件头部的少量字节，从 EXIF（JPG 和各种 RAW）或视频文件的 mvhd 中获取拍摄时间
+TIFF_MAGICS = (b'II*\x00', b'MM\x00*', b'IIRO', b'IIRS', b'IIU\x00')  # 标准 TIFF、奥林巴斯 ORF、松下 RW2
+CANON_CR3_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+# mvhd 中的时间从 1904-01-01 UTC 开始计算
+MP4_EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _read_ifd(f, base, offset, endian, wanted):
+    """读取 TIFF 中的一个 IFD，返回 wanted 中各个标签的值
+
+    ASCII 标签返回字符串，SHORT 和 LONG 标签返回整数，包含多个 LONG 值的标签（例如 SubIFDs）返回元组
+    """
+    f.seek(base + offset)
+    (count,) = struct.unpack(endian + 'H', f.read(2))
+    data = f.read(min(count, 512) * 12)
+    values = {}
+    for i in range(0, len(data) - 11, 12):
+        tag, value_type, value_count = struct.unpack(endian + 'HHI', data[i:i + 8])
+        if tag not in wanted:
+            continue
+        raw = data[i + 8:i + 12]
+        if value_type == 2:  # ASCII
+            if value_count > 4:
+                (value_offset,) = struct.unpack(endian + 'I', raw)
+                f.seek(base + value_offset)
+                raw = f.read(min(value_count, 64))
+            values[tag] = raw[:value_count].split(b'\x00', 1)[0].decode('ascii', 'ignore')
+        elif value_type == 3 and value_count == 1:  # SHORT
+            (values[tag],) = struct.unpack(endian + 'H', raw[:2])
+        elif value_type in (4, 13) and value_count == 1:  # LONG / IFD
+            (values[tag],) = struct.unpack(endian + 'I', raw)
+        elif value_type in (4, 13):
+            (value_offset,) = struct.unpack(endian + 'I', raw)
+            f.seek(base + value_offset)
+            n = min(value_count, 16)
+            values[tag] = struct.unpack(endian + f'{n}I', f.read(n * 4))
+    return values
+
+
+def _parse_exif_datetime(value):
+    try:
+        return datetime.datetime.strptime(value.strip()[:19], '%Y:%m:%d %H:%M:%S')
+    except (AttributeError, ValueError):
+        return None
+
+
+def _read_tiff_datetime(f, base):
+    """解析从 base 开始的 TIFF 结构，优先返回 DateTimeOriginal，其次 DateTimeDigitized 和 IFD0 的 DateTime"""
+    f.seek(base)
+    header = f.read(8)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    (ifd_offset,) = struct.unpack(endian + 'I', header[4:8])
+    wanted = {TAG_DATETIME, TAG_EXIF_IFD, TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED}
+    ifd0 = _read_ifd(f, base, ifd_offset, endian, wanted)
+    exif = {}
+    if ifd0.get(TAG_EXIF_IFD):
+        exif = _read_ifd(f, base, ifd0[TAG_EXIF_IFD], endian, {TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED})
+    # 佳能 CR3 的 CMT2 本身就是 EXIF IFD，拍摄时间直接位于第一个 IFD 中
+    for values, tag in ((exif, TAG_DATETIME_ORIGINAL), (ifd0, TAG_DATETIME_ORIGINAL),
+                        (exif, TAG_DATETIME_DIGITIZED), (ifd0, TAG_DATETIME)):
+        parsed = _parse_exif_datetime(values.get(tag))
+        if parsed:
+            return parsed
+    return None
+
+
+def _read_jpeg_datetime(f, start=0):
+    """依次跳过 JPEG 的各个段，只读取 APP1（EXIF）段"""
+    f.seek(start)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    position = start + 2
+    while True:
+        f.seek(position)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code in (0xDA, 0xD9):  # 图像数据开始，后面不会再有 EXIF
+            return None
+        (length,) = struct.unpack('>H', marker[2:])
+        if code == 0xE1 and f.read(6) == b'Exif\x00\x00':
+            return _read_tiff_datetime(f, position + 10)
+        position += 2 + length
+
+
+def _iter_boxes(f, start, end):
+    """遍历 ISO BMFF（MP4/MOV/CR3）中 start 到 end 之间的 box，返回 (类型, 内容起点, 终点)"""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack('>Q', f.read(8))
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            return
+        yield box_type, position + header_size, position + size
+        position += size
+
+
+def _find_box(f, start, end, box_type):
+    for found_type, content_start, content_end in _iter_boxes(f, start, end):
+        if found_type == box_type:
+            return content_start, content_end
+    return None
+
+
+def _read_cr3_datetime(f, file_size):
+    moov = _find_box(f, 0, file_size, b'moov')
+    if moov is None:
+        return None
+    for box_type, content_start, content_end in _iter_boxes(f, *moov):
+        if box_type != b'uuid':
+            continue
+        f.seek(content_start)
+        if f.read(16) != CANON_CR3_UUID:
+            continue
+        # CMT2 为 EXIF IFD，CMT1 为 IFD0
+        metadata = {found_type: start for found_type, start, _ in _iter_boxes(f, content_start + 16, content_end)}
+        for cmt in (b'CMT2', b'CMT1'):
+            if cmt in metadata:
+                parsed = _read_tiff_datetime(f, metadata[cmt])
+                if parsed:
+                    return parsed
+    return None
+
+
+def _read_mp4_datetime(f, file_size):
+    moov = _find_box(f, 0, file_size, b'moov')
+    mvhd = moov and _find_box(f, moov[0], moov[1], b'mvhd')
+    if not mvhd:
+        return None
+    f.seek(mvhd[0])
+    version = f.read(4)[0]
+    if version == 1:
+        (seconds,) = struct.unpack('>Q', f.read(8))
+    else:
+        (seconds,) = struct.unpack('>I', f.read(4))
+    if not seconds:
+        return None
+    created = MP4_EPOCH + datetime.timedelta(seconds=seconds)
+    return created.astimezone().replace(tzinfo=None)
+
+
+def read_capture_datetime(file_path):
+    """读取照片或视频的拍摄时间，无法解析时返回 None"""
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(16)
+            if head[:2] == b'\xff\xd8':
+                return _read_jpeg_datetime(f)
+            if head[:4] in TIFF_MAGICS:
+                return _read_tiff_datetime(f, 0)
+            if head[:15] == b'FUJIFILMCCD-RAW':
+                # RAF 文件头中记录了内嵌 JPEG 的位置，拍摄时间在这个 JPEG 的 EXIF 中
+                f.seek(84)
+                (jpeg_offset,) = struct.unpack('>I', f.read(4))
+                return _read_jpeg_datetime(f, jpeg_offset)
+            if head[4:8] == b'ftyp':
+                file_size = os.fstat(f.fileno()).st_size
+                if head[8:12] == b'crx ':
+                    return _read_cr3_datetime(f, file_size)
+                return _read_mp4_datetime(f, file_size)
+    except (OSError, struct.error, IndexError, OverflowError, ValueError) as e:
+        logging.debug("Failed to read capture time of %s: %s", file_path, e)
+    return None
+
+
+_capture_date_cache = {}
+
+
+def capture_date(file_path, size, mtime):
+    """返回拍摄日期（YYYYMMDD），结果按 (路径, 大小, 修改时间) 缓存，文件没有变化时不会重复读取"""
+    key = (file_path, size, mtime)
+    if key not in _capture_date_cache:
+        captured = read_capture_datetime(file_path)
+        _capture_date_cache[key] = captured.strftime('%Y%m%d') if captured else None
+    return _capture_date_cache[key]
+
+
+# SD 卡索引中的一个文件：路径、大小、修改时间、日期（YYYYMMDD）和类别
+ScanEntry = namedtuple('ScanEntry', 'path size mtime date category')
+
+
+def _directory_fingerprint(directory):
+    stat = os.stat(directory)
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+class CardScanIndex:
+    """用 os.scandir 遍历一次 SD 卡建立的图片和视频文件索引，获取日期和拷贝共用同一份结果
+
+    扫描时记录每个文件夹的设备号、inode 和修改时间作为指纹，同一个读卡器换了一张卡或者卡上增删了文件后
+    is_current() 返回 False，需要重新扫描
+    """
+
+    def __init__(self, root, date_source=copy_date_source, workers=8):
+        self.root = root
+        self.date_source = date_source
+        self.workers = workers
+        self.entries = []
+        # 文件夹 -> 扫描时的指纹
+        self.fingerprint = {}
+        self.scan()
+
+    def is_current(self):
+        """卡上的文件夹是否与扫描时相同"""
+        try:
+            return all(_directory_fingerprint(directory) == fingerprint
+                       for directory, fingerprint in self.fingerprint.items())
+        except OSError:
+            return False
+
+    def scan(self):
+        entries = []
+        fingerprint = {}
+        pending_dirs = [self.root]
+        while pending_dirs:
+            directory = pending_dirs.pop()
+            logging.debug("Processing directory: %s", directory)
+            sub_dirs = []
+            try:
+                # 在读取目录内容之前记录指纹，扫描过程中卡上发生的变化也会导致下次重新扫描
+                fingerprint[directory] = _directory_fingerprint(directory)
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                            continue
+                        category = classify_file(entry.name)
+                        if category is None or not entry.is_file():
+                            continue
+                        try:
+                            # Windows 上 DirEntry.stat() 直接使用遍历目录时得到的信息，不需要额外访问磁盘
+                            stat = entry.stat()
+                            date_taken = datetime.datetime.fromtimestamp(stat.st_mtime).strftime('%Y%m%d')
+                        except (OSError, ValueError) as e:
+                            logging.error("Failed to get modification time for %s: %s", entry.name, e)
+                            continue
+                        entries.append(ScanEntry(entry.path, stat.st_size, stat.st_mtime, date_taken, category))
+            except OSError as e:
+                logging.error("Failed to scan directory %s: %s", directory, e)
+            # 与 os.walk 一样按目录顺序处理子目录
+            pending_dirs.extend(reversed(sub_dirs))
+
+        if self.date_source == DATE_SOURCE_EXIF and entries:
+            # 并行读取各个文件头部的拍摄时间，读取不到时保留修改时间
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                captured = executor.map(lambda e: capture_date(e.path, e.size, e.mtime), entries)
+                entries = [entry._replace(date=date) if date else entry for entry, date in zip(entries, captured)]
+        self.entries = entries
+        self.fingerprint = fingerprint
+
+    def dates(self):
+        return sorted({entry.date for entry in self.entries})
+
+
+class CopyManifest:
+    """目标目录下的拷贝记录，以追加写入的 JSON Lines 文件保存，用于中断后重新拷贝时跳过已完成的文件
+
+    记录以 (源文件相对 SD 卡根目录的路径, 大小, 修改时间) 为键，目标路径保存为相对目标目录的路径，
+    这样换了读卡器盘符或者移动了图库也能继续使用。
+    """
+    file_name = '.photoassistant_manifest.jsonl'
+
+    def __init__(self, target_root):
+        self.target_root = target_root
+        self.path = os.path.join(target_root, self.file_name)
+        self.lock = threading.Lock()
+        self.records = {}
+        self.file = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.records[(record['source'], record['size'], record['mtime'])] = record
+                    except (ValueError, KeyError):
+                        # 断电等情况下最后一行可能只写了一半
+                        logging.warning("Ignoring damaged manifest line in %s", self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error("Failed to read manifest %s: %s", self.path, e)
+
+    def lookup(self, source, size, mtime):
+        """返回已经拷贝并仍然存在的记录，没有时返回 None"""
+        record = self.records.get((source, size, mtime))
+        if record and os.path.exists(os.path.join(self.target_root, record['destination'])):
+            return record
+        return None
+
+    def add(self, source, size, mtime, destination, digest, verified, algorithm=copy_hash_algorithm, backend=None):
+        record = {
+            'source': source,
+            'size': size,
+            'mtime': mtime,
+            'destination': os.path.relpath(destination, self.target_root),
+            'hash': digest,
+            'algorithm': algorithm,
+            'verified': verified,
+            'backend': backend,
+            'copied_at': time.time(),
+        }
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(line)
+                self.file.flush()
+            except OSError as e:
+                logging.error("Failed to write manifest %s: %s", self.path, e)
+            self.records[(source, size, mtime)] = record
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(target_root):
+    """获取目标目录的拷贝记录，同一个目标目录在进程内共享同一个实例"""
+    key = os.path.normcase(os.path.abspath(target_root))
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = CopyManifest(target_root)
+        return _manifests[key]
+
+
+class LibraryHashIndex:
+    """目标图库的内容哈希索引，以追加写入的 JSON Lines 文件保存，用于发现图库中已有的相同文件
+
+    只有图库中存在大小相同的文件时才需要计算源文件的哈希，大多数文件不会因为查重而多读一次。
+    """
+    file_name = '.photoassistant_library.jsonl'
+
+    def __init__(self, library_root, algorithm=copy_hash_algorithm):
+        self.library_root = library_root
+        self.algorithm = algorithm
+        self.path = os.path.join(library_root, self.file_name)
+        self.lock = threading.Lock()
+        self.by_path = {}
+        self.by_hash = {}
+        self.sizes = set()
+        self.file = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        if record['algorithm'] == self.algorithm:
+                            self.remember(record)
+                    except (ValueError, KeyError):
+                        logging.warning("Ignoring damaged library index line in %s", self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error("Failed to read library index %s: %s", self.path, e)
+
+    def remember(self, record):
+        self.by_path[record['path']] = record
+        self.by_hash[record['hash']] = record
+        self.sizes.add(record['size'])
+
+    def add(self, file_path, size, mtime, digest):
+        record = {
+            'path': os.path.relpath(file_path, self.library_root),
+            'size': size,
+            'mtime': mtime,
+            'hash': digest,
+            'algorithm': self.algorithm,
+        }
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(line)
+                self.file.flush()
+            except OSError as e:
+                logging.error("Failed to write library index %s: %s", self.path, e)
+            self.remember(record)
+
+    def find_duplicate(self, file_path, size, buffer_size=copy_buffer_size):
+        """在图库中查找与 file_path 内容相同的文件，返回 (图库中的路径, 哈希)，没有时返回 (None, None)"""
+        if size not in self.sizes:
+            return None, None
+        digest = hash_file(file_path, buffer_size, self.algorithm)
+        return self.find_digest(digest, size), digest
+
+    def find_digest(self, digest, size):
+        """按已经算好的哈希查找图库中内容相同的文件，返回图库中的路径，没有时返回 None"""
+        record = self.by_hash.get(digest)
+        if record is None or record['size'] != size:
+            return None
+        existing = os.path.join(self.library_root, record['path'])
+        try:
+            if os.path.getsize(existing) == size:
+                return existing
+        except OSError:
+            pass
+        return None
+
+    def bootstrap(self, workers=4, progress_callback=None):
+        """并行计算图库中已有文件的哈希，已经索引过且未修改的文件不会重新计算"""
+        pending = []
+        directories = [self.library_root]
+        while directories:
+            directory = directories.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif classify_file(entry.name) and entry.is_file():
+                            stat = entry.stat()
+                            record = self.by_path.get(os.path.relpath(entry.path, self.library_root))
+                            if record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+                                continue
+                            pending.append((entry.path, stat.st_size, stat.st_mtime))
+            except OSError as e:
+                logging.error("Failed to scan directory %s: %s", directory, e)
+
+        def index_file(item):
+            file_path, size, mtime = item
+            self.add(file_path, size, mtime, hash_file(file_path, algorithm=self.algorithm))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(index_file, item) for item in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except OSError as e:
+                    logging.error("Failed to hash library file: %s", e)
+                if progress_callback:
+                    progress_callback(done, len(futures))
+        return len(pending)
+
+
+_library_indexes = {}
+_library_indexes_lock = threading.Lock()
+
+
+def get_library_index(library_root, algorithm=copy_hash_algorithm):
+    """获取图库的哈希索引，同一个图库和哈希算法在进程内共享同一个实例"""
+    key = (os.path.normcase(os.path.abspath(library_root)), algorithm)
+    with _library_indexes_lock:
+        if key not in _library_indexes:
+            _library_indexes[key] = LibraryHashIndex(library_root, algorithm)
+        return _library_indexes[key]
+
+
+class TargetDirCache:
+    """目标文件夹内容的内存快照
+
+    每个文件夹第一次用到时用 scandir 读取一次文件列表，之后拷贝任务分配的文件名和创建的文件夹直接记录在快照中，
+    判断重名和是否需要创建文件夹时不再逐个访问目标磁盘，目标在 NAS 上时可以省掉大量网络往返。
+    拷贝过程中其它程序写入目标文件夹的文件不会反映在快照中，改成正式文件名时才会发现（见 place_file）。
+    调用方需要持有 PathReservations 的锁。
+    """
+
+    def __init__(self):
+        # 文件夹 -> 文件夹中的文件和子文件夹名（按操作系统规则统一大小写）
+        self.names = {}
+        # 已经确认不存在的文件夹
+        self.missing = set()
+
+    def listing(self, folder):
+        folder = os.path.normpath(folder)
+        names = self.names.get(folder)
+        if names is None:
+            names = set()
+            try:
+                # 中断的拷贝留下的临时文件不占用文件名，再次导入时分配到同一个文件名会直接覆盖它
+                with os.scandir(folder) as it:
+                    names.update(os.path.normcase(entry.name) for entry in it
+                                 if not entry.name.endswith(PARTIAL_SUFFIX))
+            except FileNotFoundError:
+                self.missing.add(folder)
+            self.names[folder] = names
+        return names
+
+    def exists(self, path):
+        folder, name = os.path.split(os.path.normpath(path))
+        return os.path.normcase(name) in self.listing(folder)
+
+    def add(self, path):
+        folder, name = os.path.split(os.path.normpath(path))
+        self.listing(folder).add(os.path.normcase(name))
+
+    def makedirs(self, folder):
+        """确保文件夹存在，返回是否新建了文件夹"""
+        folder = os.path.normpath(folder)
+        self.listing(folder)
+        if folder not in self.missing:
+            return False
+        # 多张卡同时拷贝时其它进程可能刚刚创建了同一个文件夹
+        os.makedirs(folder, exist_ok=True)
+        self.missing.discard(folder)
+        # 上级文件夹可能也是刚刚创建的
+        parent = folder
+        while os.path.dirname(parent) != parent:
+            self.add(parent)
+            parent = os.path.dirname(parent)
+            if parent not in self.missing:
+                break
+            self.missing.discard(parent)
+        return True
+
+
+class PathReservations:
+    """为目标文件分配不重名的路径，多个拷贝任务写入同一目标目录时应共享同一个实例"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 已分配的目标路径直接记入快照，防止并行拷贝时两个同名文件抢占同一个目标路径
+        self.target_dirs = TargetDirCache()
+
+    def makedirs(self, folder):
+        """确保目标文件夹存在，返回是否新建了文件夹"""
+        with self.lock:
+            return self.target_dirs.makedirs(folder)
+
+    def reserve(self, folder, file_name):
+        base_name, ext = os.path.splitext(file_name)
+        with self.lock:
+            new_file_path = os.path.join(folder, file_name)
+            counter = 1
+            while self.target_dirs.exists(new_file_path):
+                new_file_path = os.path.join(folder, f'{base_name}_{counter}{ext}')
+                counter += 1
+            self.target_dirs.add(new_file_path)
+        return new_file_path
+
+    def hold(self, paths):
+        """把已经分配好的路径（例如保存的导入计划中的目标路径）记入快照，之后不会再分配给其它文件"""
+        with self.lock:
+            for path in paths:
+                self.target_dirs.add(path)
+
+    def collided(self, path, file_name):
+        """分配的路径已经被其它程序占用（快照过期）：记入快照，按 file_name 重新分配下一个不重名的路径"""
+        with self.lock:
+            self.target_dirs.add(path)
+        return self.reserve(os.path.dirname(path), file_name)
+
+
+MetricsSnapshot = namedtuple('MetricsSnapshot',
+                             'percent done_bytes total_bytes current_mbps average_mbps eta stalled idle_seconds')
+
+
+class CopyMetrics:
+    """拷贝进度和速度统计，拷贝线程负责更新，界面或命令行定时调用 snapshot() 读取
+
+    进度按字节计算，正在拷贝的文件按已经写入的字节计入，大视频和小缩略图不再按同样的权重计算。
+    当前速度是相邻两次 snapshot() 之间速度的指数平滑，剩余时间优先按当前速度估算。
+    超过 stall_seconds 秒既没有数据写入、校验读取，也没有文件处理完时视为卡住。
+    """
+    # 两次采样之间至少间隔这么多秒才更新当前速度，避免频繁读取时速度抖动
+    min_sample_interval = 0.2
+
+    def __init__(self, stall_seconds=copy_stall_seconds, smoothing=0.3):
+        self.stall_seconds = stall_seconds
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.completed_bytes = 0
+        self.transferred_bytes = 0
+        # 正在拷贝的文件 -> 已写入的字节数
+        self.in_flight = {}
+        self.start_time = None
+        self.end_time = None
+        self.last_activity = None
+        self.last_sample = None
+        self.current_rate = None
+
+    def start(self, total_bytes):
+        now = time.monotonic()
+        with self.lock:
+            self.total_bytes = total_bytes
+            self.start_time = self.last_activity = now
+            self.last_sample = (now, 0)
+
+    def transfer(self, key, n):
+        """文件 key 又写入了 n 个字节"""
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + n
+            self.transferred_bytes += n
+            self.last_activity = time.monotonic()
+
+    def touch(self, n=0):
+        """校验时读取了数据：不计入进度和速度，但说明拷贝没有卡住"""
+        with self.lock:
+            self.last_activity = time.monotonic()
+
+    def complete(self, key, size):
+        """文件处理完毕（拷贝、跳过或失败），按完整大小计入进度"""
+        with self.lock:
+            self.in_flight.pop(key, None)
+            self.completed_bytes += size
+            self.last_activity = time.monotonic()
+
+    def finish(self):
+        with self.lock:
+            self.end_time = time.monotonic()
+
+    def percent(self):
+        with self.lock:
+            done = self.completed_bytes + sum(self.in_flight.values())
+        return min(100, int(done * 100 / self.total_bytes)) if self.total_bytes else 0
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.start_time is None:
+                return MetricsSnapshot(0, 0, 0, 0.0, 0.0, -1.0, False, 0.0)
+            done = min(self.total_bytes, self.completed_bytes + sum(self.in_flight.values()))
+            finished = self.end_time is not None
+            elapsed = max((self.end_time or now) - self.start_time, 1e-6)
+            average = self.transferred_bytes / elapsed
+            sample_time, sample_bytes = self.last_sample
+            if not finished and now - sample_time >= self.min_sample_interval:
+                rate = (self.transferred_bytes - sample_bytes) / (now - sample_time)
+                if self.current_rate is None:
+                    self.current_rate = rate
+                else:
+                    self.current_rate = self.smoothing * rate + (1 - self.smoothing) * self.current_rate
+                self.last_sample = (now, self.transferred_bytes)
+            current = 0.0 if finished else (self.current_rate or 0.0)
+            idle = 0.0 if finished else now - self.last_activity
+            remaining = self.total_bytes - done
+            rate = current or average
+            if remaining <= 0:
+                eta = 0.0
+            else:
+                eta = remaining / rate if rate > 0 else -1.0
+            percent = int(done * 100 / self.total_bytes) if self.total_bytes else (100 if finished else 0)
+        return MetricsSnapshot(percent, done, self.total_bytes, current / (1024 * 1024), average / (1024 * 1024),
+                               eta, idle >= self.stall_seconds, idle)
+
+
+class MirrorWriter:
+    """镜像导入时一个目标磁盘的写入线程
+
+    读取线程把数据块放入有界队列，写入线程按顺序写入目标文件，跨文件连续进行：慢的磁盘最多落后 buffer_bytes 字节，
+    在此之前不会拖慢另一个磁盘。每个文件写完后在这个线程中独立校验，结果通过 done_callback(键, 目标路径, 是否成功) 返回。
+    校验通过后调用 place_callback(键, 目标路径) 把临时文件改成正式文件名，返回最终的目标路径；
+    回读校验每读取一块数据后调用 verify_callback(字节数)。
+    """
+
+    def __init__(self, name, done_callback, buffer_bytes=copy_mirror_buffer_mb * 1024 * 1024,
+                 buffer_size=copy_buffer_size, verify_mode=VERIFY_READBACK, algorithm=copy_hash_algorithm,
+                 place_callback=None, verify_callback=None):
+        self.name = name
+        self.done_callback = done_callback
+        self.place_callback = place_callback
+        self.verify_callback = verify_callback
+        self.buffer_size = buffer_size
+        self.verify_mode = verify_mode
+        self.algorithm = algorithm
+        self.queue = queue.Queue(maxsize=max(2, buffer_bytes // max(1, buffer_size)))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def begin(self, key, path):
+        self.queue.put(('begin', key, path))
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def end(self, src, digest):
+        """源文件读取完毕；digest 为源文件哈希，回读校验时与目标文件比对"""
+        self.queue.put(('end', src, digest))
+
+    def abort(self):
+        """源文件读取出错，删除写了一半的目标文件"""
+        self.queue.put(('abort',))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        f = None
+        key = path = error = None
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            if isinstance(message, bytes):
+                if f is not None and error is None:
+                    try:
+                        f.write(message)
+                    except OSError as e:
+                        error = e
+            elif message[0] == 'begin':
+                _, key, path = message
+                error = None
+                try:
+                    f = open(partial_path(path), 'wb')
+                except OSError as e:
+                    f, error = None, e
+            else:
+                path, ok = self.finish(f, key, path, message, error)
+                f = None
+                self.done_callback(key, path, ok)
+
+    def place(self, key, path):
+        if self.place_callback is not None:
+            return self.place_callback(key, path)
+        _place_or_discard(partial_path(path), path)
+        return path
+
+    def finish(self, f, key, path, message, error):
+        """关闭并校验一个目标文件，返回 (最终的目标路径, 是否成功)"""
+        try:
+            if f is not None:
+                f.close()
+            if error is not None:
+                raise error
+            if message[0] == 'abort':
+                raise OSError('读取源文件失败')
+            _, src, digest = message
+            partial = partial_path(path)
+            shutil.copystat(src, partial)
+            if (self.verify_mode == VERIFY_READBACK
+                    and hash_file(partial, self.buffer_size, self.algorithm, self.verify_callback) != digest):
+                raise HashMismatchError(path)
+            return self.place(key, path), True
+        except HashMismatchError:
+            logging.error('哈希校验失败（%s）: %s', self.name, path)
+        except Exception as e:
+            logging.error('写入%s时出错: %s, 错误信息: %s', self.name, path, e)
+        # 不保留写了一半或校验失败的临时文件
+        discard_file(partial_path(path))
+        return path, False
+
+
+# 导入计划中每个文件的处理方式：拷贝 / 用硬链接代替拷贝（图库中已有相同文件）/ 之前已经拷贝过 /
+# 图库中已有相同文件，跳过 / 不在所选日期中 / 生成计划时出错
+PLAN_COPY = 'copy'
+PLAN_LINK = 'link'
+PLAN_SKIP = 'skip'
+PLAN_DUPLICATE = 'duplicate'
+PLAN_EXCLUDED = 'excluded'
+PLAN_ERROR = 'error'
+PLAN_ACTIONS = (PLAN_COPY, PLAN_LINK, PLAN_SKIP, PLAN_DUPLICATE, PLAN_EXCLUDED, PLAN_ERROR)
+
+
+class PlanItem(namedtuple('PlanItem', 'path size mtime date category action destination duplicate digest mirror',
+                          defaults=(None,))):
+    """导入计划中的一个文件，与 ScanEntry 同名的字段可以直接当作 ScanEntry 使用
+
+    destination 为拷贝或硬链接的目标路径，跳过时为之前拷贝到的路径；duplicate 为图库中内容相同的文件；
+    mirror 为镜像导入时第二份拷贝的目标路径，不需要镜像或镜像目录中已经有这个文件时为 None
+    """
+    __slots__ = ()
+
+    @property
+    def renamed(self):
+        """目标文件夹中已有同名文件，目标文件名加上了 _1、_2 等后缀"""
+        return self.action in (PLAN_COPY, PLAN_LINK) and \
+            os.path.basename(self.destination) != os.path.basename(self.path)
+
+
+class IngestPlan:
+    """一张卡的完整导入计划：在拷贝任何数据之前确定每个文件的目标路径、大小、类别和处理方式
+
+    文件按 DCIM 子文件夹分组排列，同一文件夹内保持目录中的顺序（通常就是写入卡的顺序），拷贝时按这个顺序读取。
+    可以保存为 JSON 查看，检查之后再用 from_dict 读回来交给 IngestJob 执行。
+    """
+
+    def __init__(self, sd_card, items, event_folders, folders, created_at=None, settings=None):
+        self.sd_card = sd_card
+        self.items = list(items)
+        # 日期_活动名称 文件夹，以及拷贝前需要创建的全部文件夹（包括 JPG、RAW 子文件夹）
+        self.event_folders = list(event_folders)
+        self.folders = list(folders)
+        self.created_at = created_at or time.time()
+        # 生成计划时使用的目标目录、活动名称和哈希算法，执行保存的计划时用来还原拷贝任务
+        self.settings = dict(settings or {})
+
+    def count(self, action):
+        return sum(1 for item in self.items if item.action == action)
+
+    def total_bytes(self):
+        return sum(item.size for item in self.items)
+
+    def copy_bytes(self):
+        """需要实际写入目标磁盘的字节数，硬链接不占用空间"""
+        return sum(item.size for item in self.items if item.action == PLAN_COPY)
+
+    def mirrored(self):
+        return any(item.mirror for item in self.items)
+
+    def summary(self):
+        return {
+            'src': self.sd_card,
+            'files': len(self.items),
+            'bytes': self.total_bytes(),
+            'copy_files': self.count(PLAN_COPY),
+            'copy_bytes': self.copy_bytes(),
+            'linked': self.count(PLAN_LINK),
+            'skipped': self.count(PLAN_SKIP),
+            'duplicates': self.count(PLAN_DUPLICATE),
+            'excluded': self.count(PLAN_EXCLUDED),
+            'errors': self.count(PLAN_ERROR),
+            'renamed': sum(1 for item in self.items if item.renamed),
+            'mirror_files': sum(1 for item in self.items if item.mirror),
+            'folders': self.event_folders,
+        }
+
+    def describe(self):
+        """计划的中文说明，用于界面和命令行"""
+        summary = self.summary()
+        text = (f"共 {summary['files']} 个文件（{summary['bytes'] / (1024 * 1024):.0f} MB），"
+                f"拷贝 {summary['copy_files']} 个（{summary['copy_bytes'] / (1024 * 1024):.0f} MB）")
+        for key, label in (('linked', '以硬链接代替拷贝'), ('skipped', '之前已拷贝'), ('duplicates', '图库中已有'),
+                           ('excluded', '不在所选日期'), ('renamed', '重名自动改名'), ('mirror_files', '镜像拷贝'),
+                           ('errors', '出错')):
+            if summary[key]:
+                text += f"，{label} {summary[key]} 个"
+        if self.event_folders:
+            text += f"\n目标文件夹：{', '.join(self.event_folders)}"
+        return text
+
+    def lines(self):
+        """逐个文件的计划，每行一个文件"""
+        for item in self.items:
+            if item.action in (PLAN_COPY, PLAN_LINK, PLAN_SKIP):
+                line = f'{item.action:9s} {item.path} -> {item.destination}'
+                yield line + f' + {item.mirror}' if item.mirror else line
+            elif item.action == PLAN_DUPLICATE:
+                yield f'{item.action:9s} {item.path} = {item.duplicate}'
+            else:
+                yield f'{item.action:9s} {item.path}'
+
+    def stale_items(self):
+        """卡上与生成计划时不一致（已经删除，或者大小、修改时间变了）的文件，执行保存的计划之前检查"""
+        stale = []
+        for item in self.items:
+            if item.action in (PLAN_EXCLUDED, PLAN_ERROR):
+                continue
+            try:
+                stat = os.stat(item.path)
+            except OSError:
+                stale.append(item)
+                continue
+            if stat.st_size != item.size or stat.st_mtime != item.mtime:
+                stale.append(item)
+        return stale
+
+    def to_dict(self):
+        return {
+            'src': self.sd_card,
+            'created_at': self.created_at,
+            'settings': self.settings,
+            'event_folders': self.event_folders,
+            'folders': self.folders,
+            'items': [item._asdict() for item in self.items],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['src'], [PlanItem(**item) for item in data['items']], data['event_folders'],
+                   data['folders'], data.get('created_at'), data.get('settings'))
+
+
+def _existing_ancestor(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+# 目标磁盘上的位置、需要写入的字节数、剩余空间
+SpaceShortfall = namedtuple('SpaceShortfall', 'path required free')
+
+
+def check_free_space(plans, margin_bytes=copy_free_space_margin_mb * 1024 * 1024):
+    """按目标磁盘汇总各个计划需要写入的数据量，返回剩余空间不足的磁盘；多张卡拷贝到同一磁盘时合并计算"""
+    folder_bytes = {}
+    for plan in plans:
+        for item in plan.items:
+            destinations = [item.destination] if item.action == PLAN_COPY else []
+            if item.mirror:
+                destinations.append(item.mirror)
+            for destination in destinations:
+                folder = os.path.dirname(destination)
+                folder_bytes[folder] = folder_bytes.get(folder, 0) + item.size
+    required = {}
+    for folder, size in folder_bytes.items():
+        root = _existing_ancestor(folder)
+        device = device_of(root)
+        path, total = required.get(device if device is not None else root, (root, 0))
+        required[device if device is not None else root] = (path, total + size)
+    shortfalls = []
+    for path, size in required.values():
+        try:
+            free = shutil.disk_usage(path).free
+        except OSError as e:
+            logging.warning("Failed to get free space of %s: %s", path, e)
+            continue
+        if size + margin_bytes > free:
+            shortfalls.append(SpaceShortfall(path, size, free))
+    return shortfalls
+
+
+def space_shortfall_message(shortfalls):
+    parts = [f"{shortfall.path} 需要 {shortfall.required / (1024 * 1024):.0f} MB，"
+             f"剩余 {shortfall.free / (1024 * 1024):.0f} MB" for shortfall in shortfalls]
+    return "目标磁盘空间不足，没有拷贝任何文件：" + "；".join(parts)
+
+
+class IngestJob:
+    """把一张 SD 卡上的照片和视频拷贝到目标目录的一次导入任务，不依赖 Qt，界面和命令行共用
+
+    progress_callback(百分比) 在按字节计算的进度百分比变化时调用；更详细的速度、剩余时间和卡顿信息
+    由 metrics 提供，由调用方定时读取。run() 先生成导入计划（也可以传入之前用 make_plan() 生成的计划），
+    检查目标磁盘空间后再按计划拷贝，返回结果说明
+    """
+    # 每次交给一个拷贝线程的小文件数和字节数，同一批文件由一个线程按顺序读取
+    batch_files = 32
+    batch_bytes = 64 * 1024 * 1024
+    # 大于这个大小的文件（主要是视频）单独拷贝，同一时间只拷贝一个，多个线程不会在卡上来回寻道
+    stream_bytes = 64 * 1024 * 1024
+
+    def __init__(self, image_target, separate_mode, video_target, sd_card, event_name, selected_dates,
+                 buffer_size=copy_buffer_size, verify_mode=copy_verify_mode, workers=copy_workers,
+                 reservations=None, scan_index=None, dedupe_mode=copy_dedupe_mode,
+                 hash_algorithm=copy_hash_algorithm, progress_callback=None, backend=None, plan=None,
+                 mirror_image_target=None, mirror_video_target=None):
+        self.image_target = image_target
+        self.separate_mode = separate_mode
+        self.video_target = video_target
+        # 镜像导入：同时拷贝第二份到这两个目录，为空时不镜像
+        self.mirror_image_target = mirror_image_target
+        self.mirror_video_target = mirror_video_target
+        self.sd_card = sd_card
+        self.event_name = event_name
+        self.selected_dates = selected_dates
+        self.buffer_size = buffer_size
+        self.verify_mode = verify_mode
+        self.workers = max(1, workers)
+        self.dedupe_mode = dedupe_mode
+        self.hash_algorithm = hash_algorithm
+        self.backend = backend or copy_backend
+        self.created_folders = []
+        self.reservations = reservations or PathReservations()
+        self.scan_index = scan_index
+        self.progress_callback = progress_callback
+        self.plan = plan
+        # 没有开始拷贝就中止时的原因（例如目标磁盘空间不足）
+        self.error = None
+        self.stream_lock = threading.Lock()
+        self.last_progress = -1
+        self.metrics = CopyMetrics()
+        # 拷贝统计，供多卡调度器计算进度、速度和剩余时间
+        self.total_files = 0
+        self.done_files = 0
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.copied_bytes = 0
+        self.skipped_files = 0
+        self.duplicate_files = 0
+        self.linked_files = 0
+        self.failed_files = 0
+        self.copied_files = 0
+        self.mirrored_files = 0
+        # 主目标拷贝成功但镜像目标写入或校验失败的文件，不计入 failed_files
+        self.mirror_failed_files = 0
+        # 拷贝方式 -> 使用这种方式拷贝的文件数
+        self.backend_counts = {}
+        # 文件夹 -> 设备号，选择拷贝方式时使用；多个拷贝线程同时写入时最多重复 stat 一次
+        self.folder_devices = {}
+        self.start_time = None
+        self.end_time = None
+
+    def report_progress(self, progress=None):
+        """进度百分比变化时才回调，文件很多时不会每个文件都通知一次界面"""
+        if progress is None:
+            progress = self.metrics.percent()
+        if progress != self.last_progress and self.progress_callback is not None:
+            self.last_progress = progress
+            self.progress_callback(progress)
+
+    def run(self):
+        self.start_time = time.monotonic()
+        if self.plan is None:
+            self.plan = self.make_plan()
+        plan = self.plan
+
+        self.total_files = len(plan.items)
+        self.total_bytes = plan.total_bytes()
+        self.metrics.start(self.total_bytes)
+
+        if not plan.items:
+            self.metrics.finish()
+            return "SD 卡目录中没有可用的图片或视频文件，请检查路径。"
+
+        # 在写入任何数据之前检查目标磁盘空间，不会拷贝到一半才发现磁盘已满
+        shortfalls = check_free_space([plan])
+        if shortfalls:
+            self.error = space_shortfall_message(shortfalls)
+            logging.error(self.error)
+            self.metrics.finish()
+            self.end_time = time.monotonic()
+            return self.error
+
+        self.create_folders()
+        if plan.mirrored():
+            self.run_mirrored()
+        elif self.workers > 1:
+            self.run_pipelined()
+        else:
+            for item in plan.items:
+                new_file_path, failed = self.resolve(item)
+                if new_file_path:
+                    new_file_path, digest, backend = self.copy_file(item, new_file_path)
+                    self.account(item, new_file_path, digest, not new_file_path, backend)
+                else:
+                    self.account(item, failed=failed)
+                self.report_progress()
+
+        # 确保进度条达到 100%
+        self.report_progress(100)
+        self.metrics.finish()
+        self.end_time = time.monotonic()
+        summary = self.summary()
+        logging.info("Ingest finished for %(src)s: %(files_copied)d of %(files_total)d files copied, "
+                     "%(bytes_copied)d bytes, %(mb_per_s).1f MB/s, %(skipped)d skipped, %(duplicates)d duplicates, "
+                     "%(linked)d linked, %(failed)d failed in %(seconds).1f s, backends %(backends)s", summary, extra={'summary': summary})
+
+        result_msg = f"拷贝完成，生成的文件夹有：{', '.join(self.created_folders)}"
+        if self.skipped_files:
+            result_msg += f"；跳过之前已拷贝的文件 {self.skipped_files} 个"
+        if self.duplicate_files:
+            result_msg += f"；跳过图库中已有的相同文件 {self.duplicate_files} 个"
+        if self.linked_files:
+            result_msg += f"；以硬链接代替拷贝的重复文件 {self.linked_files} 个"
+        if self.mirrored_files:
+            result_msg += f"；同时镜像拷贝的文件 {self.mirrored_files} 个"
+        if self.failed_files:
+            result_msg += f"；拷贝或校验失败的文件 {self.failed_files} 个"
+        if self.mirror_failed_files:
+            result_msg += f"；镜像拷贝失败的文件 {self.mirror_failed_files} 个"
+        return result_msg
+
+    def summary(self):
+        """本次导入的统计数据，用于日志和命令行输出"""
+        end_time = self.end_time or time.monotonic()
+        seconds = end_time - self.start_time if self.start_time is not None else 0.0
+        return {
+            'src': self.sd_card,
+            'files_total': self.total_files,
+            'files_done': self.done_files,
+            'files_copied': self.copied_files,
+            'bytes_total': self.total_bytes,
+            'bytes_copied': self.copied_bytes,
+            'skipped': self.skipped_files,
+            'duplicates': self.duplicate_files,
+            'linked': self.linked_files,
+            'failed': self.failed_files,
+            'mirrored': self.mirrored_files,
+            'mirror_failed': self.mirror_failed_files,
+            'seconds': round(seconds, 3),
+            'backends': dict(self.backend_counts),
+            'mb_per_s': round(self.copied_bytes / (1024 * 1024) / seconds, 2) if seconds > 0 else 0.0,
+        }
+
+    def target_root(self, entry):
+        return self.video_target if entry.category == 'video' else self.image_target
+
+    def mirror_root(self, entry):
+        return self.mirror_video_target if entry.category == 'video' else self.mirror_image_target
+
+    def target_folder(self, entry, root):
+        """包含活动名称的文件夹，分类拷贝时图片再按格式放到 JPG、RAW 子文件夹中，视频直接放主文件夹"""
+        folder_path = os.path.join(root, f'{entry.date}_{self.event_name}')
+        if entry.category != 'video' and self.separate_mode:
+            folder_path = os.path.join(folder_path, 'JPG' if entry.category == 'jpg' else 'RAW')
+        return folder_path
+
+    def source_key(self, entry):
+        """拷贝记录中源文件的键：相对 SD 卡根目录的路径，不受盘符变化影响"""
+        return os.path.relpath(entry.path, self.sd_card).replace(os.sep, '/')
+
+    def account(self, entry, new_file_path=None, digest=None, failed=False, backend=None):
+        """记录一个文件已处理完毕；拷贝成功时传入目标路径，同时写入拷贝记录"""
+        self.done_files += 1
+        self.done_bytes += entry.size
+        self.metrics.complete(entry.path, entry.size)
+        if failed:
+            self.failed_files += 1
+        if new_file_path:
+            self.copied_files += 1
+            self.copied_bytes += entry.size
+            self.backend_counts[backend] = self.backend_counts.get(backend, 0) + 1
+            target_dir = self.target_root(entry)
+            get_manifest(target_dir).add(self.source_key(entry), entry.size, entry.mtime, new_file_path, digest,
+                                         self.verify_mode == VERIFY_READBACK, self.hash_algorithm, backend)
+            if digest:
+                get_library_index(target_dir, self.hash_algorithm).add(new_file_path, entry.size, entry.mtime, digest)
+
+    def make_plan(self):
+        """扫描 SD 卡并生成导入计划；只分配目标路径，不创建文件夹，也不写入任何数据"""
+        # 获取日期时已经扫描过这张卡、并且之后没有换卡的话直接使用已有的索引
+        if self.scan_index is None or self.scan_index.root != self.sd_card or not self.scan_index.is_current():
+            self.scan_index = CardScanIndex(self.sd_card)
+        # 按 DCIM 子文件夹分组读取，排序是稳定的，同一文件夹内保持目录中的顺序
+        entries = sorted(self.scan_index.entries, key=lambda entry: os.path.dirname(entry.path))
+        items = []
+        event_folders = []
+        folders = []
+        for entry in entries:
+            try:
+                item = self.plan_entry(entry)
+            except Exception as e:
+                logging.error('处理文件时出错: %s, 错误信息: %s', entry.path, e)
+                item = PlanItem(entry.path, entry.size, entry.mtime, entry.date, entry.category, PLAN_ERROR,
+                                None, None, None)
+            items.append(item)
+            targets = [(self.target_root(item), item.destination)] if item.action in (PLAN_COPY, PLAN_LINK) else []
+            if item.mirror:
+                targets.append((self.mirror_root(item), item.mirror))
+            for root, destination in targets:
+                event_folder = os.path.join(root, f'{item.date}_{self.event_name}')
+                for folder in (event_folder, os.path.dirname(destination)):
+                    if folder not in folders:
+                        folders.append(folder)
+                if event_folder not in event_folders:
+                    event_folders.append(event_folder)
+        settings = {
+            'image_target': self.image_target,
+            'video_target': self.video_target,
+            'mirror_image_target': self.mirror_image_target,
+            'mirror_video_target': self.mirror_video_target,
+            'separate': self.separate_mode,
+            'event': self.event_name,
+            'hash_algorithm': self.hash_algorithm,
+        }
+        return IngestPlan(self.sd_card, items, event_folders, folders, settings=settings)
+
+    def skip_copied(self):
+        """执行保存的计划之前调用：生成计划之后已经拷贝过的文件改为跳过，同一个计划执行两次不会生成 _1、_2 副本"""
+        items = []
+        for item in self.plan.items:
+            if item.action in (PLAN_COPY, PLAN_LINK):
+                target_dir = self.target_root(item)
+                record = get_manifest(target_dir).lookup(self.source_key(item), item.size, item.mtime)
+                if record and self.reusable(record):
+                    item = item._replace(action=PLAN_SKIP, destination=os.path.join(target_dir, record['destination']))
+            if item.mirror:
+                record = get_manifest(self.mirror_root(item)).lookup(self.source_key(item), item.size, item.mtime)
+                if record and self.reusable(record):
+                    item = item._replace(mirror=None)
+            items.append(item)
+        self.plan.items = items
+
+    def plan_entry(self, entry):
+        """决定一个文件的处理方式和目标路径；镜像导入时另外分配镜像目录中的目标路径"""
+        item = self.plan_primary(entry)
+        mirror_root = self.mirror_root(entry)
+        if not mirror_root or item.action == PLAN_EXCLUDED:
+            return item
+        # 镜像目录按自己的拷贝记录判断是否已经有这个文件，主目录跳过的文件也可能需要补上镜像
+        record = get_manifest(mirror_root).lookup(self.source_key(entry), entry.size, entry.mtime)
+        if record and self.reusable(record):
+            return item
+        if record:
+            return item._replace(mirror=os.path.join(mirror_root, record['destination']))
+        # 主目录中已有相同内容的文件时，镜像目录也按自己的图库索引判断是否已有，没有时仍然需要拷贝一份
+        if item.action == PLAN_DUPLICATE:
+            try:
+                library = get_library_index(mirror_root, self.hash_algorithm)
+                # 查重时已经算出了源文件的哈希，直接按哈希查找，不再读一遍卡上的文件
+                if item.digest:
+                    duplicate = library.find_digest(item.digest, entry.size)
+                else:
+                    duplicate, _ = library.find_duplicate(entry.path, entry.size, self.buffer_size)
+            except OSError as e:
+                logging.error("Failed to check mirror duplicates for %s: %s", entry.path, e)
+                duplicate = None
+            if duplicate:
+                return item
+        mirror = self.reservations.reserve(self.target_folder(entry, mirror_root), os.path.basename(entry.path))
+        return item._replace(mirror=mirror)
+
+    def reusable(self, record):
+        """拷贝记录中的文件是否可以直接跳过
+
+        只有回读比对过目标文件的记录才标记为已校验；本次要求回读校验而之前没有回读过时，重新拷贝覆盖原来的文件，
+        不会生成 _1、_2 副本
+        """
+        return record['verified'] or self.verify_mode != VERIFY_READBACK
+
+    def replaceable(self, item, root, destination):
+        """destination 是否是拷贝记录中这个源文件之前没有回读校验过的拷贝，可以直接覆盖"""
+        record = get_manifest(root).lookup(self.source_key(item), item.size, item.mtime)
+        return (record is not None and not self.reusable(record)
+                and os.path.normcase(os.path.join(root, record['destination'])) == os.path.normcase(destination))
+
+    def place(self, item, destination, root=None):
+        """把校验通过的临时文件改成正式文件名，返回最终的目标路径
+
+        其它程序在拷贝期间写入了同名文件时不覆盖它，记入快照后换下一个 _1、_2 后缀；出错时删除临时文件
+        """
+        partial = partial_path(destination)
+        overwrite = self.replaceable(item, root or self.target_root(item), destination)
+        try:
+            while True:
+                try:
+                    place_file(partial, destination, overwrite)
+                    return destination
+                except FileExistsError:
+                    logging.warning("%s already exists, it was written by another program; choosing a new name",
+                                    destination)
+                    destination = self.reservations.collided(destination, os.path.basename(item.path))
+                    overwrite = False
+        except BaseException:
+            discard_file(partial)
+            raise
+
+    def plan_primary(self, entry):
+        file = os.path.basename(entry.path)
+        item = PlanItem(entry.path, entry.size, entry.mtime, entry.date, entry.category, PLAN_COPY, None, None, None)
+        if self.selected_dates and entry.date not in self.selected_dates:
+            return item._replace(action=PLAN_EXCLUDED)
+
+        target_dir = self.target_root(entry)
+
+        # 之前已经拷贝（并校验）过的文件直接跳过，不再生成 _1、_2 副本
+        record = get_manifest(target_dir).lookup(self.source_key(entry), entry.size, entry.mtime)
+        if record and self.reusable(record):
+            return item._replace(action=PLAN_SKIP, destination=os.path.join(target_dir, record['destination']))
+        if record:
+            return item._replace(destination=os.path.join(target_dir, record['destination']))
+
+        # 图库中已经有相同内容的文件（例如没有格式化的卡再次导入）时跳过或建立硬链接
+        duplicate = None
+        digest = None
+        if self.dedupe_mode != DEDUPE_OFF:
+            try:
+                library = get_library_index(target_dir, self.hash_algorithm)
+                duplicate, digest = library.find_duplicate(entry.path, entry.size, self.buffer_size)
+            except OSError as e:
+                logging.error("Failed to check duplicates for %s: %s", file, e)
+            if duplicate and self.dedupe_mode == DEDUPE_SKIP:
+                return item._replace(action=PLAN_DUPLICATE, duplicate=duplicate, digest=digest)
+
+        # 目标文件夹中有同名文件时自动加上 _1、_2 等后缀
+        destination = self.reservations.reserve(self.target_folder(entry, target_dir), file)
+        return item._replace(action=PLAN_LINK if duplicate else PLAN_COPY, destination=destination,
+                             duplicate=duplicate, digest=digest)
+
+    def create_folders(self):
+        for folder in self.plan.folders:
+            try:
+                if self.reservations.makedirs(folder):
+                    logging.info("Created folder: %s", folder)
+            except Exception as e:
+                # 这个文件夹中的文件会在拷贝时失败并计入失败数
+                logging.error("Failed to create folder %s: %s", folder, e)
+        self.created_folders = list(self.plan.event_folders)
+
+    def resolve(self, item):
+        """处理计划中不需要拷贝数据的文件，返回 (需要拷贝到的目标路径, 是否失败)"""
+        file = os.path.basename(item.path)
+        if item.action in (PLAN_EXCLUDED, PLAN_ERROR):
+            return None, item.action == PLAN_ERROR
+        if item.action == PLAN_SKIP:
+            logging.debug("Skipping %s, already copied to %s", file, item.destination)
+            self.skipped_files += 1
+            return None, False
+        target_dir = self.target_root(item)
+        if item.action == PLAN_DUPLICATE:
+            logging.debug("Skipping %s, identical to %s", file, item.duplicate)
+            # 源文件哈希与图库中已有文件的记录一致，不会再写入这个文件，记为已校验
+            get_manifest(target_dir).add(self.source_key(item), item.size, item.mtime, item.duplicate, item.digest,
+                                         True, self.hash_algorithm)
+            self.duplicate_files += 1
+            return None, False
+        if item.action == PLAN_LINK:
+            try:
+                os.link(item.duplicate, item.destination)
+                logging.debug("Linked %s to %s", file, item.duplicate)
+                get_manifest(target_dir).add(self.source_key(item), item.size, item.mtime,
+                                             item.destination, item.digest, True, self.hash_algorithm)
+                self.linked_files += 1
+                return None, False
+            except OSError as e:
+                # 不同分区或文件系统不支持硬链接时照常拷贝
+                logging.warning("Failed to link %s to %s, copying instead: %s", file, item.duplicate, e)
+        return item.destination, False
+
+    def folder_device(self, folder):
+        """文件夹所在的设备号，每个源/目标文件夹在一次导入中只 stat 一次"""
+        device = self.folder_devices.get(folder)
+        if device is None:
+            device = self.folder_devices[folder] = _folder_device(folder)
+        return device
+
+    def copy_file(self, item, new_file_path, verify_mode=None, place=True):
+        """拷贝单个文件并进行哈希校验，返回 (最终的目标路径, 源文件哈希, 拷贝方式)，失败时目标路径为 None
+
+        place 为 False 时数据留在临时文件中，由校验线程回读校验后再改成正式文件名
+        """
+        file = os.path.basename(item.path)
+        try:
+            logging.debug("Copying %s to %s", file, new_file_path)
+            digest, backend = copy_file_with_backend(item.path, new_file_path, self.buffer_size,
+                                                     verify_mode or self.verify_mode, self.hash_algorithm,
+                                                     lambda n: self.metrics.transfer(item.path, n), self.backend,
+                                                     place=False, device_of=self.folder_device,
+                                                     verify_callback=self.metrics.touch)
+            if place:
+                new_file_path = self.place(item, new_file_path)
+            logging.debug('成功拷贝: %s (%s)', file, backend)
+            return new_file_path, digest, backend
+        except HashMismatchError:
+            logging.error('哈希校验失败: %s', file)
+        except Exception as e:
+            logging.error('拷贝文件时出错: %s, 错误信息: %s', file, e)
+        return None, None, None
+
+    def run_pipelined(self):
+        """流水线拷贝：按计划分批的线程 -> 多个拷贝线程 -> 校验线程，各阶段之间用有界队列连接
+
+        同一文件夹中连续的小文件合并成一批交给一个拷贝线程按顺序读取，大文件单独成批并且同一时间只拷贝一个
+        """
+        items = self.plan.items
+        copy_queue = queue.Queue(maxsize=self.workers * 2)
+        verify_queue = queue.Queue(maxsize=self.workers * 2)
+        done_queue = queue.Queue()
+        # 回读校验放到独立的校验线程中，拷贝线程只负责边写边计算源文件哈希
+        readback = self.verify_mode == VERIFY_READBACK
+        copy_verify_mode = VERIFY_HASH if readback else self.verify_mode
+
+        def produce():
+            batch = []
+            batch_bytes = 0
+            for item in items:
+                try:
+                    new_file_path, failed = self.resolve(item)
+                except Exception as e:
+                    logging.error('处理文件时出错: %s, 错误信息: %s', item.path, e)
+                    new_file_path, failed = None, True
+                if not new_file_path:
+                    done_queue.put((item, None, None, failed, None))
+                    continue
+                if batch and (len(batch) >= self.batch_files or batch_bytes + item.size > self.batch_bytes
+                              or os.path.dirname(batch[-1][0].path) != os.path.dirname(item.path)
+                              or item.size >= self.stream_bytes):
+                    copy_queue.put(batch)
+                    batch = []
+                    batch_bytes = 0
+                batch.append((item, new_file_path))
+                batch_bytes += item.size
+                if item.size >= self.stream_bytes:
+                    copy_queue.put(batch)
+                    batch = []
+                    batch_bytes = 0
+            if batch:
+                copy_queue.put(batch)
+            for _ in range(self.workers):
+                copy_queue.put(None)
+
+        def copy_one(entry, new_file_path):
+            new_file_path, digest, backend = self.copy_file(entry, new_file_path, copy_verify_mode, not readback)
+            if readback and new_file_path:
+                verify_queue.put((entry, new_file_path, digest, backend))
+            else:
+                done_queue.put((entry, new_file_path, digest, not new_file_path, backend))
+
+        def copy_worker():
+            while True:
+                batch = copy_queue.get()
+                if batch is None:
+                    verify_queue.put(None)
+                    return
+                if len(batch) == 1 and batch[0][0].size >= self.stream_bytes:
+                    with self.stream_lock:
+                        copy_one(*batch[0])
+                    continue
+                for entry, new_file_path in batch:
+                    copy_one(entry, new_file_path)
+
+        def verify_worker():
+            finished_workers = 0
+            while finished_workers < self.workers:
+                item = verify_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+                entry, new_file_path, digest, backend = item
+                partial = partial_path(new_file_path)
+                verified = False
+                try:
+                    verified = hash_file(partial, self.buffer_size, self.hash_algorithm, self.metrics.touch) == digest
+                    if verified:
+                        new_file_path = self.place(entry, new_file_path)
+                    else:
+                        logging.error('哈希校验失败: %s', os.path.basename(entry.path))
+                except Exception as e:
+                    verified = False
+                    logging.error('校验文件时出错: %s, 错误信息: %s', new_file_path, e)
+                if not verified:
+                    discard_file(partial)
+                done_queue.put((entry, new_file_path if verified else None, digest, not verified, backend))
+
+        threads = [threading.Thread(target=produce, daemon=True),
+                   threading.Thread(target=verify_worker, daemon=True)]
+        threads += [threading.Thread(target=copy_worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        for _ in range(len(items)):
+            self.account(*done_queue.get())
+            self.report_progress()
+
+        for thread in threads:
+            thread.join()
+
+    def run_mirrored(self):
+        """镜像导入：每个数据块只从卡上读取一次，同时交给主目标和镜像目标的写入线程
+
+        卡只按计划顺序读取一遍，总耗时接近拷贝一份到较慢的目标磁盘；两个目标各自校验，只有镜像目标失败时单独计数
+        """
+        items = self.plan.items
+        done_queue = queue.Queue()
+
+        def written(key, path, ok):
+            done_queue.put(('written', key, path, ok))
+
+        def place(key, path):
+            index, side = key
+            item = items[index]
+            return self.place(item, path, self.mirror_root(item) if side == 'mirror' else None)
+
+        writers = {side: MirrorWriter(name, written, buffer_size=self.buffer_size, verify_mode=self.verify_mode,
+                                      algorithm=self.hash_algorithm, place_callback=place,
+                                      verify_callback=self.metrics.touch)
+                   for side, name in (('primary', '主目标'), ('mirror', '镜像目标'))}
+
+        def read_all():
+            for index, item in enumerate(items):
+                try:
+                    new_file_path, failed = self.resolve(item)
+                except Exception as e:
+                    logging.error('处理文件时出错: %s, 错误信息: %s', item.path, e)
+                    new_file_path, failed = None, True
+                destinations = [('primary', new_file_path)] if new_file_path else []
+                if item.mirror and not failed:
+                    destinations.append(('mirror', item.mirror))
+                if not destinations:
+                    done_queue.put(('read', index, None, failed, 0))
+                    continue
+                for side, path in destinations:
+                    writers[side].begin((index, side), path)
+                hasher = new_hasher(self.hash_algorithm) if self.verify_mode != VERIFY_NONE else None
+                digest = None
+                read_failed = False
+                try:
+                    with open(item.path, 'rb', buffering=0) as f:
+                        while True:
+                            chunk = f.read(self.buffer_size)
+                            if not chunk:
+                                break
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            for side, _ in destinations:
+                                writers[side].write(chunk)
+                            self.metrics.transfer(item.path, len(chunk))
+                    digest = hasher.hexdigest() if hasher is not None else None
+                except OSError as e:
+                    logging.error('读取文件时出错: %s, 错误信息: %s', item.path, e)
+                    read_failed = True
+                for side, _ in destinations:
+                    if read_failed:
+                        writers[side].abort()
+                    else:
+                        writers[side].end(item.path, digest)
+                done_queue.put(('read', index, digest, read_failed, len(destinations)))
+            for writer in writers.values():
+                writer.close()
+
+        reader = threading.Thread(target=read_all, daemon=True)
+        reader.start()
+        # 文件索引 -> 读取结果和各个目标的写入结果，全部到齐后才算处理完一个文件
+        reads = {}
+        results = {}
+        remaining = len(items)
+        while remaining:
+            message = done_queue.get()
+            if message[0] == 'read':
+                _, index, digest, read_failed, expected = message
+                reads[index] = (digest, read_failed, expected)
+            else:
+                _, (index, side), path, ok = message
+                results.setdefault(index, {})[side] = (path, ok)
+            if index not in reads or len(results.get(index, ())) < reads[index][2]:
+                continue
+            digest, read_failed, _ = reads.pop(index)
+            self.account_mirrored(items[index], digest, read_failed, results.pop(index, {}))
+            self.report_progress()
+            remaining -= 1
+        reader.join()
+
+    def account_mirrored(self, item, digest, read_failed, results):
+        """记录镜像导入的一个文件：读取或主目标失败计入 failed_files，只有镜像目标失败时计入 mirror_failed_files"""
+        primary_path, primary_ok = results.get('primary', (None, False))
+        failed = read_failed or ('primary' in results and not primary_ok)
+        self.account(item, primary_path if primary_ok else None, digest, failed,
+                     BACKEND_USERSPACE if primary_ok else None)
+        if 'mirror' not in results:
+            return
+        mirror_path, mirror_ok = results['mirror']
+        if not mirror_ok:
+            if not read_failed:
+                self.mirror_failed_files += 1
+            return
+        self.mirrored_files += 1
+        mirror_root = self.mirror_root(item)
+        get_manifest(mirror_root).add(self.source_key(item), item.size, item.mtime, mirror_path,
+                                      digest, self.verify_mode == VERIFY_READBACK, self.hash_algorithm,
+                                      BACKEND_USERSPACE)
+        if digest:
+            get_library_index(mirror_root, self.hash_algorithm).add(mirror_path, item.size, item.mtime, digest)
+
+
+# 分类拷贝时在日期文件夹下建立的子文件夹，配对时视为同一次拍摄
+SEPARATE_SUBFOLDERS = ('jpg', 'raw')
+# 同一组中的预览图（JPG/HEIF 等）、RAW 文件和附属文件（XMP 等）
+PairGroup = namedtuple('PairGroup', 'previews raws sidecars')
+
+
+class PairingIndex:
+    """RAW 文件与同名预览图的配对索引，可以逐个文件增删
+
+    以 (拍摄文件夹, 文件名主干) 为键：拍摄文件夹是文件所在的文件夹，分类拷贝生成的 JPG/RAW 子文件夹
+    会归到上一级，这样同一次拍摄的 JPG 和 RAW 能配上，不同文件夹里碰巧同名的文件不会互相配对。
+    add/remove 返回 (新增的未匹配 RAW, 不再未匹配的 RAW)，方便增量更新界面。
+    """
+
+    def __init__(self):
+        self.groups = {}
+        # 文件夹 -> 其中已加入索引的文件，用于增量刷新单个文件夹
+        self.directories = {}
+        self.preview_count = 0
+        self.raw_count = 0
+
+    @staticmethod
+    def key_of(path):
+        directory, name = os.path.split(path)
+        if os.path.basename(directory).lower() in SEPARATE_SUBFOLDERS:
+            directory = os.path.dirname(directory)
+        stem, ext = os.path.splitext(name)
+        # darktable 等软件的附属文件名为 IMG_0001.CR3.xmp
+        inner_stem, inner_ext = os.path.splitext(stem)
+        if (inner_ext and ext.lower() in ('.xmp', '.thm')
+                and (inner_ext.lower() in MEDIA_TYPES or inner_ext.lower() in PREVIEW_ONLY_EXTENSIONS)):
+            stem = inner_stem
+        return os.path.normcase(directory), stem.lower()
+
+    @staticmethod
+    def category_of(path):
+        if os.path.splitext(path)[1].lower() in PREVIEW_ONLY_EXTENSIONS:
+            return 'jpg'
+        media_type = media_type_of(path)
+        if media_type is None or media_type.category == 'video':
+            return None
+        return media_type.category
+
+    def add(self, path):
+        category = self.category_of(path)
+        if category is None:
+            return [], []
+        self.directories.setdefault(os.path.normpath(os.path.dirname(path)), set()).add(path)
+        key = self.key_of(path)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = PairGroup(set(), set(), set())
+        if category == 'jpg':
+            if path in group.previews:
+                return [], []
+            group.previews.add(path)
+            self.preview_count += 1
+            if len(group.previews) == 1:
+                return [], list(group.raws)
+        elif category == 'raw':
+            if path in group.raws:
+                return [], []
+            group.raws.add(path)
+            self.raw_count += 1
+            if not group.previews:
+                return [path], []
+        else:
+            group.sidecars.add(path)
+        return [], []
+
+    def remove(self, path):
+        category = self.category_of(path)
+        key = self.key_of(path)
+        group = self.groups.get(key)
+        if category is None or group is None:
+            return [], []
+        directory = os.path.normpath(os.path.dirname(path))
+        files = self.directories.get(directory)
+        if files is not None:
+            files.discard(path)
+            if not files:
+                del self.directories[directory]
+        added, removed = [], []
+        if category == 'jpg':
+            if path in group.previews:
+                group.previews.discard(path)
+                self.preview_count -= 1
+                if not group.previews:
+                    added = list(group.raws)
+        elif category == 'raw':
+            if path in group.raws:
+                group.raws.discard(path)
+                self.raw_count -= 1
+                if not group.previews:
+                    removed = [path]
+        else:
+            group.sidecars.discard(path)
+        if not (group.previews or group.raws or group.sidecars):
+            del self.groups[key]
+        return added, removed
+
+    def refresh_directory(self, directory):
+        """重新读取一个文件夹（不含子文件夹），把增删的文件同步到索引中
+
+        返回 (新增的未匹配 RAW, 不再未匹配的 RAW, 子文件夹列表)
+        """
+        current = set()
+        sub_dirs = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif self.category_of(entry.name) is not None:
+                    current.add(entry.path)
+        known = self.directories.get(os.path.normpath(directory), set())
+        changes = [self.remove(path) for path in known - current]
+        changes += [self.add(path) for path in sorted(current - known)]
+        added, removed = merge_pairing_changes(changes)
+        return added, removed, sub_dirs
+
+    def remove_tree(self, directory):
+        """文件夹被删除或移走时，从索引中去掉其中（包括子文件夹中）的所有文件"""
+        directory = os.path.normpath(directory)
+        prefix = os.path.join(directory, '')
+        changes = []
+        for key in [key for key in self.directories if key == directory or key.startswith(prefix)]:
+            changes += [self.remove(path) for path in list(self.directories.get(key, ()))]
+        return merge_pairing_changes(changes)
+
+    def unmatched(self):
+        """返回所有没有预览图的 RAW 文件"""
+        return [path for group in self.groups.values() if not group.previews for path in sorted(group.raws)]
+
+    def sidecars_for(self, path):
+        """返回与 RAW 文件同组的附属文件，删除或移动 RAW 时一起处理"""
+        group = self.groups.get(self.key_of(path))
+        return sorted(group.sidecars) if group is not None else []
+
+
+def merge_pairing_changes(changes):
+    """合并多次 add/remove 的结果，同一个 RAW 先后变化时以最后一次为准"""
+    state = {}
+    for added, removed in changes:
+        for path in added:
+            state[path] = True
+        for path in removed:
+            state[path] = False
+    return [path for path, unmatched in state.items() if unmatched], \
+        [path for path, unmatched in state.items() if not unmatched]
+
+
+class PairingScan:
+    """遍历目录建立配对索引，查找没有同名 JPG 的 RAW 文件，边扫描边分批回调结果，可以随时取消
+
+    added_callback(新发现的未匹配 RAW 路径列表)，removed_callback(后来找到了同名 JPG 的 RAW 路径列表)，
+    counts_callback(JPG 数量, RAW 数量)；run() 扫描完成时返回 True，被取消时返回 False
+    """
+    flush_interval = 0.1
+
+    def __init__(self, path, added_callback=None, removed_callback=None, counts_callback=None):
+        self.path = path
+        self.added_callback = added_callback
+        self.removed_callback = removed_callback
+        self.counts_callback = counts_callback
+        self.index = PairingIndex()
+        # 扫描过的所有文件夹，扫描结束后用来监视文件变化
+        self.directories = []
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        index = self.index
+        # 用 dict 保存待发送的新增路径，保持发现顺序的同时可以快速撤销
+        added = {}
+        removed = []
+        last_flush = time.monotonic()
+
+        def flush():
+            if added and self.added_callback is not None:
+                self.added_callback(list(added))
+            if removed and self.removed_callback is not None:
+                self.removed_callback(list(removed))
+            added.clear()
+            removed.clear()
+            if self.counts_callback is not None:
+                self.counts_callback(index.preview_count, index.raw_count)
+
+        pending_dirs = [self.path]
+        while pending_dirs and not self.cancelled.is_set():
+            directory = pending_dirs.pop()
+            self.directories.append(directory)
+            sub_dirs = []
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                            continue
+                        new_unmatched, matched = index.add(entry.path)
+                        for path in new_unmatched:
+                            added[path] = True
+                        # 之前已经列出的 RAW 现在有了对应的 JPG
+                        for path in matched:
+                            if added.pop(path, None) is None:
+                                removed.append(path)
+            except OSError as e:
+                logging.error("Failed to scan directory %s: %s", directory, e)
+            pending_dirs.extend(reversed(sub_dirs))
+            if time.monotonic() - last_flush >= self.flush_interval:
+                flush()
+                last_flush = time.monotonic()
+
+        if not self.cancelled.is_set():
+            flush()
+        return not self.cancelled.is_set()
+
+
+def device_of(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def cross_device_files(paths, target_dir):
+    """返回与目标目录不在同一磁盘上的文件及其总大小，这些文件移动时需要完整拷贝一遍"""
+    target_device = device_of(target_dir)
+    files = []
+    total_bytes = 0
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_dev != target_device:
+            files.append(path)
+            total_bytes += st.st_size
+    return files, total_bytes
+
+
+class FileOperation:
+    """把一批文件删除到回收站或移动到目标目录，逐个报告错误，可以随时取消
+
+    删除时按批调用回收站接口；移动时同一磁盘上的文件直接 os.rename，只有跨磁盘的文件才拷贝后删除。
+    progress_callback(百分比)，files_done_callback(已处理成功的路径列表，分批回调)，
+    error_callback(文件路径, 错误信息)；run() 返回结果说明
+    """
+    OP_TRASH = 'trash'
+    OP_MOVE = 'move'
+    flush_interval = 0.1
+
+    def __init__(self, operation, paths, target_dir=None, trash_batch_size=cleanup_trash_batch_size,
+                 progress_callback=None, files_done_callback=None, error_callback=None):
+        self.operation = operation
+        self.progress_callback = progress_callback
+        self.files_done_callback = files_done_callback
+        self.error_callback = error_callback
+        self.paths = list(paths)
+        self.target_dir = target_dir
+        self.trash_batch_size = max(1, trash_batch_size)
+        self.cancelled = threading.Event()
+        self.processed = 0
+        self.failed = 0
+        self.renamed = 0
+        self.done = []
+        self.last_flush = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def succeeded(self, paths):
+        self.processed += len(paths)
+        self.done.extend(paths)
+        self.flush()
+
+    def fail(self, path, error):
+        self.processed += 1
+        self.failed += 1
+        logging.error("处理 %s 时出错: %s", path, error)
+        if self.error_callback is not None:
+            self.error_callback(path, str(error))
+        self.flush()
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self.last_flush < self.flush_interval:
+            return
+        if self.done and self.files_done_callback is not None:
+            self.files_done_callback(self.done)
+        self.done = []
+        total = len(self.paths)
+        if self.progress_callback is not None:
+            self.progress_callback(int(self.processed * 100 / total) if total else 100)
+        self.last_flush = time.monotonic()
+
+    def trash_files(self):
+        # send2trash 在 Windows 上会加载 COM 相关模块，只在真正删除时导入
+        from send2trash import send2trash
+        for start in range(0, len(self.paths), self.trash_batch_size):
+            if self.cancelled.is_set():
+                return
+            batch = [os.path.normpath(path) for path in self.paths[start:start + self.trash_batch_size]]
+            existed = [os.path.lexists(path) for path in batch]
+            try:
+                send2trash(batch)
+                logging.info("已删除到回收站: %s 个文件", len(batch))
+                self.succeeded(self.paths[start:start + len(batch)])
+                continue
+            except Exception as e:
+                logging.warning("批量删除失败，改为逐个删除: %s", e)
+            # 整批失败时可能已经删除了其中一部分，逐个处理剩下的文件以便准确报告错误
+            for path, norm_path, existed in zip(self.paths[start:start + len(batch)], batch, existed):
+                if existed and not os.path.lexists(norm_path):
+                    self.succeeded([path])
+                    continue
+                try:
+                    send2trash(norm_path)
+                    self.succeeded([path])
+                except Exception as e:
+                    self.fail(path, e)
+
+    def move_files(self):
+        target_device = device_of(self.target_dir)
+        for path in self.paths:
+            if self.cancelled.is_set():
+                return
+            new_path = os.path.join(self.target_dir, os.path.basename(path))
+            try:
+                if os.path.lexists(new_path):
+                    raise FileExistsError(f"目标目录中已有同名文件 {new_path}")
+                if device_of(path) == target_device:
+                    os.rename(path, new_path)
+                    self.renamed += 1
+                else:
+                    shutil.move(path, new_path)
+                logging.debug("已剪切到新目录: %s -> %s", path, new_path)
+                self.succeeded([path])
+            except Exception as e:
+                self.fail(path, e)
+
+    def run(self):
+        if self.operation == self.OP_TRASH:
+            self.trash_files()
+        else:
+            self.move_files()
+        self.flush(force=True)
+        total = len(self.paths)
+        action = "删除" if self.operation == self.OP_TRASH else "移动"
+        result = f"已{action} {self.processed - self.failed} 个文件"
+        if self.operation == self.OP_MOVE and self.processed - self.failed - self.renamed:
+            result += f"（其中 {self.processed - self.failed - self.renamed} 个跨磁盘拷贝）"
+        if self.failed:
+            result += f"，{self.failed} 个文件失败"
+        if self.cancelled.is_set() and self.processed < total:
+            result += f"，已取消，剩余 {total - self.processed} 个文件未处理"
+        logging.info(result)
+        return result
+
+
+# 清理页面的预览图：只读取 RAW 文件中内嵌 JPEG 所在的字节范围，不需要解码 RAW 数据
+CANON_PREVIEW_UUID = bytes.fromhex('eaf42b5e1c984b88b9fbb7dc406e4d16')
+TAG_NEW_SUBFILE_TYPE = 0x00FE
+TAG_COMPRESSION = 0x0103
+TAG_STRIP_OFFSETS = 0x0111
+TAG_ORIENTATION = 0x0112
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_SUBIFDS = 0x014A
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+# 可以显示的 JPEG 编码方式：基线、扩展、渐进；RAW 数据常用的无损 JPEG（SOF3）不在其中
+DISPLAYABLE_JPEG_MARKERS = (0xC0, 0xC1, 0xC2)
+
+# 内嵌预览图在文件中的位置、长度，以及 RAW 文件记录的方向（1～8，未知时为 None，由 JPEG 自身的 EXIF 决定）
+EmbeddedPreview = namedtuple('EmbeddedPreview', 'offset length orientation')
+
+
+def _is_displayable_jpeg(f, start):
+    """跳过 JPEG 开头的各个段，检查编码方式是否可以直接显示"""
+    f.seek(start)
+    if f.read(2) != b'\xff\xd8':
+        return False
+    position = start + 2
+    for _ in range(64):
+        f.seek(position)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return False
+        code = marker[1]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            return code in DISPLAYABLE_JPEG_MARKERS
+        if code in (0xDA, 0xD9):
+            return False
+        (length,) = struct.unpack('>H', marker[2:])
+        position += 2 + length
+    return False
+
+
+def _next_ifd_offset(f, base, offset, endian):
+    f.seek(base + offset)
+    (count,) = struct.unpack(endian + 'H', f.read(2))
+    f.seek(base + offset + 2 + count * 12)
+    data = f.read(4)
+    return struct.unpack(endian + 'I', data)[0] if len(data) == 4 else 0
+
+
+def _tiff_previews(f, base):
+    """遍历 TIFF 结构中的 IFD 链和 SubIFDs，返回所有内嵌 JPEG 的 (位置, 长度) 和 IFD0 中记录的方向
+
+    NEF、ARW、CR2、DNG、ORF 等大多数 RAW 都是 TIFF 结构：预览图或者由 JPEGInterchangeFormat 指向，
+    或者是只有一个 JPEG 压缩条带的子图像
+    """
+    f.seek(base)
+    header = f.read(8)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return [], None
+    (ifd_offset,) = struct.unpack(endian + 'I', header[4:8])
+    wanted = {TAG_NEW_SUBFILE_TYPE, TAG_COMPRESSION, TAG_STRIP_OFFSETS, TAG_STRIP_BYTE_COUNTS, TAG_ORIENTATION,
+              TAG_SUBIFDS, TAG_JPEG_OFFSET, TAG_JPEG_LENGTH}
+    previews = []
+    orientation = None
+    pending = [ifd_offset]
+    visited = set()
+    while pending and len(visited) < 16:
+        offset = pending.pop(0)
+        if not offset or offset in visited:
+            continue
+        visited.add(offset)
+        values = _read_ifd(f, base, offset, endian, wanted)
+        if len(visited) == 1:
+            orientation = values.get(TAG_ORIENTATION)
+        if values.get(TAG_JPEG_OFFSET) and values.get(TAG_JPEG_LENGTH):
+            previews.append((base + values[TAG_JPEG_OFFSET], values[TAG_JPEG_LENGTH]))
+        strip_offset, strip_length = values.get(TAG_STRIP_OFFSETS), values.get(TAG_STRIP_BYTE_COUNTS)
+        if values.get(TAG_COMPRESSION) in (6, 7) and isinstance(strip_offset, int) and isinstance(strip_length, int):
+            previews.append((base + strip_offset, strip_length))
+        sub_ifds = values.get(TAG_SUBIFDS, ())
+        pending.extend(sub_ifds if isinstance(sub_ifds, tuple) else (sub_ifds,))
+        pending.append(_next_ifd_offset(f, base, offset, endian))
+    return previews, orientation
+
+
+def _jpeg_in_box(f, start, end):
+    """CR3 的 PRVW 和 THMB 在宽高等字段之后直接存放 JPEG 数据"""
+    f.seek(start)
+    position = f.read(32).find(b'\xff\xd8\xff')
+    return (start + position, end - start - position) if position >= 0 else None
+
+
+def _cr3_previews(f, file_size):
+    """CR3 的大预览图（PRVW）位于单独的 uuid box 中，缩略图（THMB）和方向（CMT1）位于 moov 的佳能 uuid box 中"""
+    previews = []
+    orientation = None
+    for box_type, content_start, content_end in _iter_boxes(f, 0, file_size):
+        if box_type == b'uuid':
+            f.seek(content_start)
+            if f.read(16) != CANON_PREVIEW_UUID:
+                continue
+            # uuid 之后有 8 字节未知数据，然后才是 PRVW box
+            for found_type, start, end in _iter_boxes(f, content_start + 24, content_end):
+                if found_type == b'PRVW':
+                    previews.append(_jpeg_in_box(f, start, end))
+        elif box_type == b'moov':
+            for found_type, start, end in _iter_boxes(f, content_start, content_end):
+                if found_type != b'uuid':
+                    continue
+                f.seek(start)
+                if f.read(16) != CANON_CR3_UUID:
+                    continue
+                for canon_type, canon_start, canon_end in _iter_boxes(f, start + 16, end):
+                    if canon_type == b'THMB':
+                        previews.append(_jpeg_in_box(f, canon_start, canon_end))
+                    elif canon_type == b'CMT1':
+                        _, orientation = _tiff_previews(f, canon_start)
+    return [preview for preview in previews if preview], orientation
+
+
+def find_embedded_preview(file_path):
+    """返回文件中最大的可显示内嵌 JPEG（EmbeddedPreview），找不到时返回 None
+
+    支持 CR3、RAF 和 TIFF 结构的 RAW（CR2、NEF、ARW、DNG、ORF、RW2 等），JPG 文件本身返回整个文件
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            head = f.read(16)
+            if head[:2] == b'\xff\xd8':
+                return EmbeddedPreview(0, file_size, None)
+            orientation = None
+            if head[:4] in TIFF_MAGICS:
+                previews, orientation = _tiff_previews(f, 0)
+            elif head[:15] == b'FUJIFILMCCD-RAW':
+                f.seek(84)
+                previews = [struct.unpack('>II', f.read(8))]
+            elif head[4:8] == b'ftyp' and head[8:12] == b'crx ':
+                previews, orientation = _cr3_previews(f, file_size)
+            else:
+                return None
+            previews = [(offset, length) for offset, length in previews
+                        if length > 0 and offset + length <= file_size and _is_displayable_jpeg(f, offset)]
+    except (OSError, struct.error, IndexError, OverflowError, ValueError) as e:
+        logging.debug("Failed to find embedded preview in %s: %s", file_path, e)
+        return None
+    if not previews:
+        return None
+    offset, length = max(previews, key=lambda preview: preview[1])
+    return EmbeddedPreview(offset, length, orientation)
+
+
+def read_embedded_preview(file_path):
+    """读取内嵌预览图，返回 (JPEG 数据, 方向)；找不到预览图时返回 None"""
+    preview = find_embedded_preview(file_path)
+    if preview is None:
+        return None
+    with open(file_path, 'rb') as f:
+        f.seek(preview.offset)
+        return f.read(preview.length), preview.orientation
+
+
+class PreviewDiskCache:
+    """缩放后的预览图在磁盘上的缓存，按 (路径, 大小, 修改时间) 命名，文件被修改后自动失效
+
+    读取时更新缓存文件的修改时间，超过大小上限时删除最久没有用到的文件。多个线程可以同时读写。
+    """
+
+    def __init__(self, directory=preview_cache_directory, max_bytes=preview_cache_mb * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # 上次清理之后写入的字节数，超过上限的十分之一时再检查一次总大小
+        self.written_bytes = 0
+
+    def path_for(self, path, size, mtime):
+        key = hashlib.sha1(f'{os.path.abspath(path)}\0{size}\0{mtime}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.jpg')
+
+    def get(self, path, size, mtime):
+        cache_path = self.path_for(path, size, mtime)
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            os.utime(cache_path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, path, size, mtime, data):
+        cache_path = self.path_for(path, size, mtime)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # 先写入临时文件再改名，其它线程不会读到写了一半的缓存
+            temp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.debug("Failed to write preview cache %s: %s", cache_path, e)
+            return
+        with self.lock:
+            self.written_bytes += len(data)
+            if self.written_bytes < self.max_bytes // 10:
+                return
+            self.written_bytes = 0
+        self.prune()
+
+    def prune(self):
+        """删除最久没有用到的缓存文件，直到总大小不超过上限的 80%"""
+        try:
+            with os.scandir(self.directory) as it:
+                files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in it
+                         if entry.is_file() and entry.name.endswith('.jpg')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        for _, size, cache_path in sorted(files):
+            if total <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(cache_path)
+                total -= size
+            except OSError:
+                pass